@@ -0,0 +1,180 @@
+"""Per-user hashed TF-IDF index for ranking activities against a job title.
+
+Each activity is turned into a sparse vector of hashed word and character
+trigram features from its title, skills, type and description. Queries are
+scored by cosine similarity with IDF weights computed over the user's own
+activities, which takes milliseconds even for long histories. Trigrams
+only refine the ranking: an activity sharing no word stem with the query
+scores 0, since nearly every text shares some trigram with any title.
+
+Indexes are tagged with the User.activity_version they reflect. Writes made by
+this process update them in place. Any other version change (a write in
+another worker, a bulk import) makes the next search rebuild the index from
+the database.
+"""
+import re
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+DIMENSIONS = 2 ** 18
+WORD_RE = re.compile(r'[a-z0-9+#]+')
+FIELD_WEIGHTS = {'title': 2.0, 'skills': 2.0, 'activity_type': 0.5, 'description': 1.0}
+TRIGRAM_WEIGHT = 0.3  # Lets "engineer" partly match "engineering"
+STEM_CHARS = 5  # Word prefix that counts as a shared word: "engin", "learn"
+STOP_WORDS = {'a', 'an', 'and', 'as', 'at', 'by', 'for', 'from', 'in', 'of', 'on', 'or', 'the', 'to', 'with'}
+
+
+def stem_bucket(word):
+    return zlib.crc32(f's:{word[:STEM_CHARS]}'.encode()) % DIMENSIONS
+
+
+def vectorize(doc):
+    """Return (indices, values) of the hashed, log-scaled term counts of `doc`."""
+    counts = {}
+    for field, weight in FIELD_WEIGHTS.items():
+        value = doc.get(field) or ''
+        text = ' '.join(map(str, value)) if isinstance(value, list) else str(value)
+        for word in WORD_RE.findall(text.lower()):
+            bucket = zlib.crc32(f'w:{word}'.encode()) % DIMENSIONS
+            counts[bucket] = counts.get(bucket, 0.0) + weight
+            if word not in STOP_WORDS:
+                bucket = stem_bucket(word)
+                counts[bucket] = counts.get(bucket, 0.0) + weight * TRIGRAM_WEIGHT
+            padded = f'<{word}>'
+            for i in range(len(padded) - 2):
+                bucket = zlib.crc32(f't:{padded[i:i + 3]}'.encode()) % DIMENSIONS
+                counts[bucket] = counts.get(bucket, 0.0) + weight * TRIGRAM_WEIGHT
+    if not counts:
+        counts[0] = 0.0  # Keeps every row non-empty for np.add.reduceat
+    indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = np.log1p(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+    return indices, values
+
+
+class ActivityIndex:
+    def __init__(self, version):
+        self.version = version
+        self.rows = {}  # activity_id -> (title, date, indices, values)
+        self._packed = None
+
+    def upsert(self, doc):
+        self.rows[doc['activity_id']] = (doc.get('title') or '', doc.get('date') or '', *vectorize(doc))
+        self._packed = None
+
+    def remove(self, activity_id):
+        if self.rows.pop(activity_id, None) is not None:
+            self._packed = None
+
+    def _pack(self):
+        if self._packed is None:
+            entries = list(self.rows.values())
+            lengths = np.array([len(entry[2]) for entry in entries], dtype=np.int64)
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            indices = np.concatenate([entry[2] for entry in entries])
+            values = np.concatenate([entry[3] for entry in entries])
+
+            # IDF only over the buckets that occur, so memory follows the user's vocabulary
+            # (a row's buckets are unique, so occurrences count documents)
+            buckets, columns = np.unique(indices, return_inverse=True)
+            document_frequency = np.bincount(columns, minlength=len(buckets))
+            idf = (np.log((1 + len(entries)) / (1 + document_frequency)) + 1).astype(np.float32)
+            weighted = values * idf[columns]
+            norms = np.sqrt(np.add.reduceat(weighted * weighted, offsets))
+            self._packed = (
+                [entry[0] for entry in entries],
+                np.array([entry[1] for entry in entries]),
+                offsets, indices, columns, weighted, np.maximum(norms, 1e-9), buckets, idf
+            )
+        return self._packed
+
+    def search(self, query, limit):
+        """Return up to `limit` (title, score) pairs, best first, most recent first on ties."""
+        if not self.rows:
+            return []
+        titles, dates, offsets, indices, columns, weighted, norms, buckets, idf = self._pack()
+
+        # Query terms no activity has get the IDF of a document frequency of 0
+        query_indices, query_values = vectorize({'title': query})
+        positions = np.minimum(np.searchsorted(buckets, query_indices), len(buckets) - 1)
+        known = buckets[positions] == query_indices
+        query_idf = np.where(known, idf[positions], np.float32(np.log(1 + len(titles)) + 1))
+        query_norm = np.linalg.norm(query_values * query_idf)
+        if query_norm == 0:
+            scores = np.zeros(len(titles), dtype=np.float32)
+        else:
+            query_weights = np.zeros(len(buckets), dtype=np.float32)
+            query_weights[positions[known]] = query_values[known] * idf[positions[known]]
+            scores = np.add.reduceat(weighted * query_weights[columns], offsets) / (norms * query_norm)
+            query_stems = np.array([stem_bucket(word) for word in WORD_RE.findall(query.lower())
+                                    if word not in STOP_WORDS], dtype=np.int64)
+            shares_stem = np.add.reduceat(np.isin(indices, query_stems).astype(np.int32), offsets) > 0
+            scores = np.where(shares_stem, scores, 0.0)
+
+        # Rounded so that near-identical scores fall back to recency
+        order = np.lexsort((dates, np.round(scores, 3)))[::-1][:limit]
+        return [(titles[i], float(scores[i])) for i in order]
+
+
+class ActivityIndexStore:
+    """LRU of per-user ActivityIndex objects.
+
+    `load(user_id)` must return (activity_version, activity docs), reading the
+    version before the activities so a concurrent write is never missed.
+    """
+
+    def __init__(self, load, max_users=256):
+        self.load = load
+        self.max_users = max_users
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+        self.rebuilds = 0
+        self.updates = 0
+
+    def search(self, user_id, version, query, limit):
+        with self.lock:
+            index = self.indexes.get(user_id)
+            if index is not None and index.version == version:
+                self.indexes.move_to_end(user_id)
+                return index.search(query, limit)
+
+        loaded_version, docs = self.load(user_id)
+        index = ActivityIndex(loaded_version)
+        for doc in docs:
+            index.upsert(doc)
+
+        with self.lock:
+            self.rebuilds += 1
+            self.indexes[user_id] = index
+            self.indexes.move_to_end(user_id)
+            while len(self.indexes) > self.max_users:
+                self.indexes.popitem(last=False)
+            return index.search(query, limit)
+
+    def upsert(self, user_id, version, doc):
+        self._apply(user_id, version, lambda index: index.upsert(doc))
+
+    def remove(self, user_id, version, activity_id):
+        self._apply(user_id, version, lambda index: index.remove(activity_id))
+
+    def _apply(self, user_id, version, change):
+        # Only a change to exactly the previous version can be applied in place
+        with self.lock:
+            index = self.indexes.get(user_id)
+            if index is None:
+                return
+            if version is not None and index.version == version - 1:
+                change(index)
+                index.version = version
+                self.updates += 1
+            else:
+                del self.indexes[user_id]
+
+    def stats(self):
+        return {
+            'users': len(self.indexes),
+            'rebuilds': self.rebuilds,
+            'incremental_updates': self.updates,
+        }
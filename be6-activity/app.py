@@ -1,31 +1,56 @@
-from flask import Flask, request, jsonify, send_file, render_template_string, send_from_directory
+from flask import Flask, Response, request, jsonify, g, make_response, stream_with_context, send_file, render_template_string, send_from_directory
 from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
 from datetime import timedelta, timezone
 from flask_cors import CORS
 import os
 from dotenv import load_dotenv
 from flask_mongoengine import MongoEngine
+from mongoengine.errors import ValidationError
+from mongoengine.queryset.visitor import Q
+from mongoengine.connection import get_db
+import gridfs
 import logging
 from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from datetime import datetime
 import requests
-from gql import gql, Client
-from gql.transport.requests import RequestsHTTPTransport
 from flask_bcrypt import Bcrypt
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 import json
+import codecs
+import csv
+import io
 import tempfile
 import secrets
 import threading
 import time
 from werkzeug.utils import secure_filename
 import base64
+import hashlib
 import uuid
 from functools import wraps
 from cryptography.fernet import Fernet
 import traceback
-import re
+import multiprocessing
+import select
+import socket
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import UnidentifiedImageError
+from PIL.Image import DecompressionBombError
+from images import IMAGE_VARIANTS, render_variants
+from response_cache import create_response_cache
+from llm_json import LLMOutputError, extract_json, validate
+from job_queue import JobDeferred, JobStats, JobWorkerPool
+from activity_index import ActivityIndexStore
+from llm_cache import create_llm_cache
+from leetcode_client import (CONTEST_HISTORY_QUERY, SUBMIT_STATS_QUERY, USER_PROFILE_QUERY,
+                             USERNAME_QUERY, LeetCodeClient)
+from llm_client import Deadline, DeadlineExceeded, LLMBusyError, OllamaClient
+from prompt_builder import PromptBudget, compact_json, dedupe, log_prompt, rank_by_relevance, truncate_text
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -66,17 +91,6 @@ cipher_suite = Fernet(ENCRYPTION_KEY)
 # Verify encryption key consistency
 print(f"Current encryption key: {ENCRYPTION_KEY[:6]}...{ENCRYPTION_KEY[-6:]}")
 
-class Activity(db.EmbeddedDocument):
-    activity_id = db.StringField(required=True, default=lambda: str(uuid.uuid4()))
-    title = db.StringField(required=True)
-    activity_type = db.StringField(required=True)  # For compatibility with existing code
-    
-    description = db.StringField()
-    date = db.DateTimeField(default=datetime.utcnow)
-    status = db.StringField(default='ongoing')
-    source = db.StringField(choices=['manual', 'github', 'leetcode'])
-   
-    skills = db.ListField(db.StringField())
 class Education(db.EmbeddedDocument):
     school = db.StringField(required=True)
     degree = db.StringField(required=True)
@@ -94,20 +108,18 @@ class Experience(db.EmbeddedDocument):
     current = db.BooleanField(default=False)
     description = db.StringField()
 
-class DailyActivity(db.EmbeddedDocument):
-    daily_activity_id = db.StringField(required=True, default=lambda: str(uuid.uuid4()))
-    title = db.StringField(required=True)
-    description = db.StringField()
-    date = db.DateTimeField(default=datetime.utcnow)
-    skills = db.ListField(db.StringField())
-
 class User(db.Document):
     meta = {
         'collection': 'activity_users',
         'indexes': [
             {'fields': ['email'], 'unique': True},
-            {'fields': ['username'], 'unique': True}
-        ]
+            {'fields': ['username'], 'unique': True},
+            {'fields': ['profile_image_hash']}
+        ],
+        # Older documents still carry the embedded activities/daily_activities
+        # lists and base64 profile_image until `flask migrate-activities` and
+        # `flask migrate-profile-images` have moved them out
+        'strict': False
     }
     
     # Basic Info
@@ -125,21 +137,145 @@ class User(db.Document):
     education = db.ListField(db.EmbeddedDocumentField(Education), default=list)
     experience = db.ListField(db.EmbeddedDocumentField(Experience), default=list)
     
-    # Activities and Integrations
-    activities = db.ListField(db.EmbeddedDocumentField(Activity), default=list)
+    # Bumped after every write that changes a GET response, used for ETags
+    data_version = db.IntField(default=0)
+    # Bumped after writes that change what a resume is generated from (profile, activities)
+    profile_version = db.IntField(default=0)
+    # Bumped after writes to the user's activities, used to tag activity_index
+    activity_version = db.IntField(default=0)
+    # profile_version the general resume draft was last generated for
+    resume_draft_version = db.IntField()
+
+    # Integrations
     github_token = db.StringField()
     leetcode_username = db.StringField()
 
-    # Add daily_activities field
-    daily_activities = db.ListField(db.EmbeddedDocumentField(DailyActivity), default=list)
-
-    # Add profile image field
-    profile_image = db.StringField(default='')
+    # Profile image, stored in image_blob_store and referenced by content hash
+    profile_image_hash = db.StringField(default='')
     profile_image_name = db.StringField(default='')
+    profile_image_type = db.StringField(default='')
 
     # Add Gemini API key field
     gemini_api_key = db.BinaryField()  # Changed from StringField to BinaryField
 
+class Activity(db.Document):
+    meta = {
+        'collection': 'activities',
+        'indexes': [
+            {'fields': ['user', '-date', '-id']},
+            {'fields': ['user', 'activity_id'], 'unique': True}
+        ]
+    }
+
+    user = db.ReferenceField(User, required=True)
+    activity_id = db.StringField(required=True, default=lambda: str(uuid.uuid4()))
+    title = db.StringField(required=True)
+    activity_type = db.StringField(required=True)  # For compatibility with existing code
+    
+    description = db.StringField()
+    date = db.DateTimeField(default=datetime.utcnow)
+    status = db.StringField(default='ongoing')
+    source = db.StringField(choices=['manual', 'github', 'leetcode'])
+   
+    skills = db.ListField(db.StringField())
+
+class DailyActivity(db.Document):
+    meta = {
+        'collection': 'daily_activities',
+        'indexes': [
+            {'fields': ['user', '-date', '-id']},
+            {'fields': ['user', 'daily_activity_id'], 'unique': True}
+        ]
+    }
+
+    user = db.ReferenceField(User, required=True)
+    daily_activity_id = db.StringField(required=True, default=lambda: str(uuid.uuid4()))
+    title = db.StringField(required=True)
+    description = db.StringField()
+    date = db.DateTimeField(default=datetime.utcnow)
+    skills = db.ListField(db.StringField())
+
+def serialize_activity(activity):
+    return {
+        'activity_id': str(activity.activity_id),
+        'title': activity.title,
+        'description': activity.description,
+        'date': activity.date.isoformat() if activity.date else None,
+        'status': activity.status,
+        'skills': activity.skills,
+        'activity_type': activity.activity_type
+    }
+
+def serialize_daily_activity(daily_activity):
+    return {
+        'daily_activity_id': str(daily_activity.daily_activity_id),
+        'title': daily_activity.title,
+        'description': daily_activity.description,
+        'date': daily_activity.date.isoformat() if daily_activity.date else None,
+        'skills': daily_activity.skills
+    }
+
+# Largest page /api/activities and /api/daily_activities will return
+MAX_ACTIVITY_PAGE_SIZE = 200
+
+def parse_date_param(value, end_of_day=False):
+    """Parse an ISO date/datetime query parameter into a naive UTC datetime."""
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    if end_of_day and len(value) == 10:
+        # A bare `to=YYYY-MM-DD` includes the whole day
+        parsed += timedelta(days=1)
+    return parsed
+
+def filter_date_range(queryset):
+    """Apply the ?from=&to= query parameters to an activity queryset."""
+    args = request.args
+    if args.get('from'):
+        queryset = queryset.filter(date__gte=parse_date_param(args['from']))
+    if args.get('to'):
+        to_date = parse_date_param(args['to'], end_of_day=True)
+        if len(args['to']) == 10:
+            queryset = queryset.filter(date__lt=to_date)
+        else:
+            queryset = queryset.filter(date__lte=to_date)
+    return queryset
+
+def paginate_by_date(queryset, serializer):
+    """Apply ?from=&to=&before=&limit= to a user's activity queryset, newest first.
+
+    `before` is the `next_cursor` of the previous page (`<iso date>,<id>`), so
+    each page is a single range scan on the (user, -date, -id) index. Returns
+    the serialized page and the cursor for the next one (None on the last page).
+    Raises ValueError/InvalidId for malformed parameters.
+    """
+    args = request.args
+    queryset = filter_date_range(queryset)
+
+    if args.get('before'):
+        before_date, before_id = args['before'].rsplit(',', 1)
+        before_date = parse_date_param(before_date)
+        before_id = ObjectId(before_id)
+        queryset = queryset.filter(
+            Q(date__lt=before_date) | Q(date=before_date, id__lt=before_id)
+        )
+
+    queryset = queryset.order_by('-date', '-id')
+
+    limit = args.get('limit')
+    if limit is None:
+        return [serializer(item) for item in queryset], None
+
+    limit = min(max(int(limit), 1), MAX_ACTIVITY_PAGE_SIZE)
+    # Fetch one extra document to know whether another page exists
+    page = list(queryset.limit(limit + 1))
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        last = page[-1]
+        next_cursor = f"{last.date.isoformat()},{last.id}"
+    return [serializer(item) for item in page], next_cursor
+
 def encrypt_api_key(api_key: str) -> bytes:
     return cipher_suite.encrypt(api_key.encode())
 
@@ -157,6 +293,32 @@ class Resume(db.Document):
     pdf_url = db.StringField()
     generated_content = db.StringField()
 
+class GenerationJob(db.Document):
+    """A queued LLM generation, drained by job_pool and polled via /api/jobs/<id>."""
+    user_id = db.ObjectIdField(required=True)
+    kind = db.StringField(required=True)  # a key of JOB_HANDLERS
+    payload = db.DictField()
+    status = db.StringField(default='queued', choices=('queued', 'running', 'done', 'failed'))
+    attempts = db.IntField(default=0)
+    status_code = db.IntField()
+    result = db.DictField()
+    error = db.StringField()
+    priority = db.IntField(default=0)  # Lower runs first; background work uses 1
+    run_after = db.DateTimeField()  # Not claimed before this time
+    created_at = db.DateTimeField(default=datetime.utcnow)
+    started_at = db.DateTimeField()
+    finished_at = db.DateTimeField()
+
+    meta = {
+        'collection': 'generation_jobs',
+        'indexes': [
+            ('status', 'priority', 'created_at'),
+            'user_id',
+            # Finished jobs are kept for a day for polling clients
+            {'fields': ['finished_at'], 'expireAfterSeconds': 86400},
+        ]
+    }
+
 # JWT Configuration
 app.config['JWT_SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'your-secret-key')
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(days=1)
@@ -213,6 +375,283 @@ class ResumeDataStore:
 # Replace global resume_data_store with instance
 resume_data_store = ResumeDataStore()
 
+class ImageBlobStore:
+    """Content-addressed image storage in GridFS.
+
+    Images are keyed by the SHA-256 of the uploaded bytes, so identical
+    uploads are stored once and users only keep the hash. Only the
+    re-encoded, metadata-free variants are stored, as `<hash>.<variant>`;
+    the upload itself is never kept.
+
+    While release() decides whether to delete an image it holds a marker in
+    `<collection>.releasing`. An upload that reuses the image waits for the
+    marker to go before checking that the variants still exist, so it never
+    keeps a hash whose variants were deleted under it.
+    """
+    def __init__(self, collection='image_blobs', release_timeout=10):
+        self.collection = collection
+        self.release_timeout = release_timeout  # Older markers were left by a crashed process
+        self._fs = None
+
+    @property
+    def fs(self):
+        if self._fs is None:
+            self._fs = gridfs.GridFS(get_db(), collection=self.collection)
+        return self._fs
+
+    @staticmethod
+    def variant_id(digest, variant):
+        return f'{digest}.{variant}'
+
+    def put_variant(self, digest, variant, data, content_type):
+        try:
+            self.fs.put(data, _id=self.variant_id(digest, variant), content_type=content_type)
+        except gridfs.errors.FileExists:
+            pass  # The same image was rendered concurrently
+
+    def has_variants(self, digest):
+        return all(self.fs.exists(self.variant_id(digest, name)) for name in IMAGE_VARIANTS)
+
+    def get(self, digest, variant):
+        """Return (data, content_type, blob_id) for a variant, or None if it is not stored."""
+        blob_id = self.variant_id(digest, variant)
+        try:
+            blob = self.fs.get(blob_id)
+        except gridfs.errors.NoFile:
+            return None
+        return blob.read(), blob.content_type, blob_id
+
+    def get_upload(self, digest):
+        """Raw upload stored by older versions, or None; only the migration reads these."""
+        try:
+            return self.fs.get(digest).read()
+        except gridfs.errors.NoFile:
+            return None
+
+    @property
+    def releasing(self):
+        return get_db()[f'{self.collection}.releasing']
+
+    def _stale_marker_cutoff(self):
+        return datetime.utcnow() - timedelta(seconds=self.release_timeout)
+
+    def wait_for_release(self, digest):
+        """Return once no release() of `digest` is deciding whether to delete it."""
+        while self.releasing.find_one({'_id': digest, 'started_at': {'$gt': self._stale_marker_cutoff()}}):
+            time.sleep(0.05)
+
+    def release(self, digest):
+        """Delete an image's variants once no user references it any more."""
+        if not digest:
+            return
+        while True:
+            self.releasing.delete_one({'_id': digest, 'started_at': {'$lte': self._stale_marker_cutoff()}})
+            try:
+                self.releasing.insert_one({'_id': digest, 'started_at': datetime.utcnow()})
+                break
+            except DuplicateKeyError:
+                time.sleep(0.05)  # Another release of the same image is running
+        try:
+            if not User.objects(profile_image_hash=digest).count():
+                self.fs.delete(digest)  # Raw upload left by older versions
+                for name in IMAGE_VARIANTS:
+                    self.fs.delete(self.variant_id(digest, name))
+        finally:
+            self.releasing.delete_one({'_id': digest})
+
+image_blob_store = ImageBlobStore()
+
+def sniff_image_type(data, default='application/octet-stream'):
+    """Detect the image MIME type from its magic bytes."""
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if data.startswith((b'GIF87a', b'GIF89a')):
+        return 'image/gif'
+    return default
+
+def profile_image_base64(user, variant):
+    """Base64 of one variant of the user's profile image, for clients that embed it in JSON."""
+    if not user.profile_image_hash:
+        return ''
+    blob = image_blob_store.get(user.profile_image_hash, variant)
+    return base64.b64encode(blob[0]).decode('utf-8') if blob else ''
+
+# Resizing is CPU bound, so it runs in worker processes created on first upload
+image_pool = None
+image_pool_lock = threading.Lock()
+IMAGE_RENDER_TIMEOUT = int(os.getenv('IMAGE_RENDER_TIMEOUT', 30))
+
+def store_image_variants(image_hash, variants):
+    for name, (data, content_type) in variants.items():
+        image_blob_store.put_variant(image_hash, name, data, content_type)
+
+def render_image_variants(data):
+    """Store the IMAGE_VARIANTS of uploaded image bytes and return the image hash.
+
+    Rendering runs in image_pool, off the request's interpreter. Raises if
+    the bytes are not an image Pillow can read.
+    """
+    global image_pool
+    image_hash = hashlib.sha256(data).hexdigest()
+    if image_blob_store.has_variants(image_hash):
+        return image_hash
+    with image_pool_lock:
+        if image_pool is None:
+            # Not fork, which would copy this process's Mongo, job and LLM client threads'
+            # state mid-flight. Each worker imports the main module once when it starts.
+            image_pool = ProcessPoolExecutor(max_workers=int(os.getenv('IMAGE_WORKERS', 2)),
+                                             mp_context=multiprocessing.get_context('forkserver'))
+        pool = image_pool
+    try:
+        variants = pool.submit(render_variants, data).result(timeout=IMAGE_RENDER_TIMEOUT)
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory); later uploads get a fresh pool
+        with image_pool_lock:
+            if image_pool is pool:
+                image_pool = None
+        pool.shutdown(wait=False)
+        raise
+    store_image_variants(image_hash, variants)
+    return image_hash
+
+def user_fields(only=None, exclude=None):
+    """Declare which User fields a view needs, e.g. @user_fields(only=('name', 'skills')).
+
+    Must be applied below @jwt_required(); the view then calls load_current_user()
+    to get a User fetched with just that projection.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            previous = g.get('user_projection')
+            g.user_projection = (tuple(only or ()), tuple(exclude or ()))
+            try:
+                return view(*args, **kwargs)
+            finally:
+                g.user_projection = previous
+        return wrapper
+    return decorator
+
+# Serialized GET responses, keyed by the same versioned key as the ETag
+response_cache = create_response_cache(
+    backend=os.getenv('RESPONSE_CACHE_BACKEND', 'memory'),
+    max_entries=int(os.getenv('RESPONSE_CACHE_SIZE', 1024)),
+    ttl=int(os.getenv('RESPONSE_CACHE_TTL', 300)),
+    redis_url=os.getenv('REDIS_URL')
+)
+
+# Response headers worth replaying from the cache
+CACHED_RESPONSE_HEADERS = {'content-type', 'x-next-cursor'}
+
+def bump_data_version(user_id, profile=False):
+    """Invalidate the user's ETags and cached responses. Call after the data write has landed.
+
+    `profile` marks a change to resume input, which also bumps
+    profile_version and schedules a resume draft. Returns the new data version.
+    """
+    updates = {'inc__data_version': 1}
+    if profile:
+        updates['inc__profile_version'] = 1
+    user = User.objects(id=user_id).only('data_version').modify(new=True, **updates)
+    response_cache.invalidate_user(str(user_id))
+    if profile and user:
+        schedule_resume_draft(user_id)
+    return user.data_version if user else None
+
+def bump_activity_version(user_id):
+    """bump_data_version for a write to the user's activities, which are resume input too.
+
+    Returns the new activity_version, which tags the user's activity_index.
+    """
+    user = User.objects(id=user_id).only('activity_version').modify(
+        new=True, inc__data_version=1, inc__profile_version=1, inc__activity_version=1)
+    response_cache.invalidate_user(str(user_id))
+    if user:
+        schedule_resume_draft(user_id)
+    return user.activity_version if user else None
+
+def activity_index_doc(activity):
+    return {
+        'activity_id': activity.activity_id,
+        'title': activity.title,
+        'activity_type': activity.activity_type,
+        'description': activity.description,
+        'skills': activity.skills,
+        'date': activity.date.isoformat() if activity.date else ''
+    }
+
+def load_activity_index(user_id):
+    # The version is read first, so a write racing with the load forces another rebuild
+    user = User.objects(id=user_id).only('activity_version').first()
+    activities = Activity.objects(user=user_id).only(
+        'activity_id', 'title', 'activity_type', 'description', 'skills', 'date')
+    return (user.activity_version if user else None), [activity_index_doc(a) for a in activities]
+
+# Per-user similarity index behind /api/activities/recommend; see activity_index.py
+activity_index = ActivityIndexStore(load_activity_index, max_users=int(os.getenv('ACTIVITY_INDEX_USERS', 256)))
+
+def conditional_get(view):
+    """Answer If-None-Match with 304 from User.data_version before running the view.
+
+    The ETag covers the view, the user, their data version and the query
+    string, so the check only reads one integer field. The same key is used
+    for response_cache, so a cached body is never older than the version.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        user_id = get_jwt_identity()
+        user = User.objects(id=user_id).only('data_version').first()
+        if user is None:
+            return view(*args, **kwargs)
+
+        etag = hashlib.sha1(
+            f'{view.__name__}:{user_id}:{user.data_version}:'.encode() + request.query_string
+        ).hexdigest()
+
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            cached = response_cache.get(user_id, etag)
+            if cached is not None:
+                status, body, headers = cached
+                response = Response(body, status=status, headers=headers)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                response_cache.set(user_id, etag, (
+                    response.status_code,
+                    response.get_data(),
+                    [(name, value) for name, value in response.headers
+                     if name.lower() in CACHED_RESPONSE_HEADERS]
+                ))
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Authorization')
+        return response
+    return wrapper
+
+def load_current_user():
+    """Return the JWT user loaded with the projection declared by @user_fields.
+
+    Users are cached on `g` per projection, so repeated calls within a request
+    hit Mongo only once.
+    """
+    only, exclude = g.get('user_projection') or ((), ())
+    cache = g.setdefault('current_users', {})
+    key = (only, exclude)
+    if key not in cache:
+        query = User.objects(id=get_jwt_identity())
+        if only:
+            query = query.only(*only)
+        elif exclude:
+            query = query.exclude(*exclude)
+        cache[key] = query.first()
+    return cache[key]
+
 @app.route('/api/auth/signup', methods=['POST'])
 def signup():
     try:
@@ -225,9 +664,9 @@ def signup():
                 return jsonify({'error': f'Missing required field: {field}'}), 400
 
         # Check existing users
-        if User.objects(email=data['email']).first():
+        if User.objects(email=data['email']).only('id').first():
             return jsonify({'error': 'Email already exists'}), 400
-        if User.objects(username=data['username']).first():
+        if User.objects(username=data['username']).only('id').first():
             return jsonify({'error': 'Username already exists'}), 400
 
         # Hash password using flask-bcrypt
@@ -268,7 +707,7 @@ def login():
         if 'email' not in data or 'password' not in data:
             return jsonify({'error': 'Missing email or password'}), 400
 
-        user = User.objects(email=data['email']).first()
+        user = User.objects(email=data['email']).only('email', 'username', 'name', 'password').first()
         
         if user and bcrypt.check_password_hash(user.password, data['password']):
             token = create_access_token(identity=str(user.id))
@@ -303,6 +742,7 @@ def add_activity():
 
         # Create new Activity document using MongoEngine model
         new_activity = Activity(
+            user=ObjectId(user_id), # User ID from JWT, no need to load the user
             title=data['title'],
             activity_type=data['activity_type'], # Updated field name
             description=data['description'],
@@ -312,13 +752,8 @@ def add_activity():
             skills=data.get('skills', [])  # Add skills with empty list as default
         )
 
-        # Find the user and append the new activity
-        user = User.objects(id=user_id).first() # Find user by ID from JWT
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-
-        user.activities.append(new_activity) # Append the MongoEngine Activity object
-        user.save() # Save the updated user document
+        new_activity.save() # Single insert into the activities collection
+        activity_index.upsert(user_id, bump_activity_version(user_id), activity_index_doc(new_activity))
 
         return jsonify({
             'message': 'Activity added successfully',
@@ -339,29 +774,22 @@ def add_activity():
 # Get user's activities
 @app.route('/api/activities', methods=['GET'])
 @jwt_required()
+@conditional_get
 def get_user_activities():
     try:
         user_id = get_jwt_identity()
-        user = User.objects(id=user_id).first()
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
 
-        activities = []
-        for activity in user.activities:
-            activity_data = {
-                'activity_id': str(activity.activity_id),
-                'title': activity.title,
-                'description': activity.description,
-                'date': activity.date.isoformat() if activity.date else None,
-                'status': activity.status,
-                
-                'skills': activity.skills,
-                'activity_type': activity.activity_type
-            }
-            activities.append(activity_data)
+        try:
+            activities, next_cursor = paginate_by_date(
+                Activity.objects(user=user_id), serialize_activity
+            )
+        except (ValueError, InvalidId) as e:
+            return jsonify({'error': 'Invalid pagination parameters', 'details': str(e)}), 400
 
-        return jsonify(activities[::-1]), 200
+        response = jsonify(activities)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response, 200
 
     except Exception as e:
         logger.error(f"Error fetching activities: {str(e)}")
@@ -369,37 +797,305 @@ def get_user_activities():
 # Get user's daily activities
 @app.route('/api/daily_activities', methods=['GET'])
 @jwt_required()
+@conditional_get
 def get_user_daily_activities():
     try:
         user_id = get_jwt_identity()
-        user = User.objects(id=user_id).first()
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
 
-        daily_activities = []
-        for daily_activity in user.daily_activities:
-            daily_activity_data = {
-                'daily_activity_id': str(daily_activity.daily_activity_id),
-                'title': daily_activity.title,
-                'description': daily_activity.description,
-                'date': daily_activity.date.isoformat() if daily_activity.date else None,
-                'skills': daily_activity.skills
-            }
-            daily_activities.append(daily_activity_data)
+        try:
+            daily_activities, next_cursor = paginate_by_date(
+                DailyActivity.objects(user=user_id), serialize_daily_activity
+            )
+        except (ValueError, InvalidId) as e:
+            return jsonify({'error': 'Invalid pagination parameters', 'details': str(e)}), 400
 
-        return jsonify(daily_activities[::-1]), 200
+        response = jsonify(daily_activities)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response, 200
 
     except Exception as e:
         logger.error(f"Error fetching in daily activities: {str(e)}")
         return jsonify({'error': 'Server error'}), 500
 
+# Columns written by the CSV export, in order
+ACTIVITY_EXPORT_FIELDS = ['activity_id', 'title', 'activity_type', 'description', 'date', 'status', 'skills']
+DAILY_ACTIVITY_EXPORT_FIELDS = ['daily_activity_id', 'title', 'description', 'date', 'skills']
+
+def stream_export(queryset, serializer, fields, basename):
+    """Stream a queryset as NDJSON (default) or CSV (?format=csv), newest first.
+
+    Documents are pulled from an uncached Mongo cursor and written one row at a
+    time, so memory does not grow with the size of the history.
+    """
+    export_format = request.args.get('format', 'ndjson').lower()
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({'error': 'format must be ndjson or csv'}), 400
+
+    try:
+        queryset = filter_date_range(queryset)
+    except ValueError as e:
+        return jsonify({'error': 'Invalid date range', 'details': str(e)}), 400
+
+    cursor = queryset.order_by('-date', '-id').no_cache().batch_size(500)
+
+    def generate_ndjson():
+        for item in cursor:
+            yield json.dumps(serializer(item)) + '\n'
+
+    def generate_csv():
+        line = io.StringIO()
+        writer = csv.writer(line)
+
+        def flush_line():
+            value = line.getvalue()
+            line.seek(0)
+            line.truncate(0)
+            return value
+
+        writer.writerow(fields)
+        yield flush_line()
+        for item in cursor:
+            row = serializer(item)
+            row['skills'] = ';'.join(row.get('skills') or [])
+            writer.writerow([row.get(field) for field in fields])
+            yield flush_line()
+
+    if export_format == 'csv':
+        body, mimetype = generate_csv(), 'text/csv'
+    else:
+        body, mimetype = generate_ndjson(), 'application/x-ndjson'
+
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={basename}.{export_format}'
+    return response
+
+@app.route('/api/activities/export', methods=['GET'])
+@jwt_required()
+def export_activities():
+    try:
+        user_id = get_jwt_identity()
+        return stream_export(
+            Activity.objects(user=user_id), serialize_activity,
+            ACTIVITY_EXPORT_FIELDS, 'activities'
+        )
+    except Exception as e:
+        logger.error(f"Error exporting activities: {str(e)}")
+        return jsonify({'error': 'Server error'}), 500
+
+@app.route('/api/daily_activities/export', methods=['GET'])
+@jwt_required()
+def export_daily_activities():
+    try:
+        user_id = get_jwt_identity()
+        return stream_export(
+            DailyActivity.objects(user=user_id), serialize_daily_activity,
+            DAILY_ACTIVITY_EXPORT_FIELDS, 'daily_activities'
+        )
+    except Exception as e:
+        logger.error(f"Error exporting daily activities: {str(e)}")
+        return jsonify({'error': 'Server error'}), 500
+
+# Bulk import limits
+IMPORT_BATCH_SIZE = 500
+MAX_IMPORT_RECORD_CHARS = 1024 * 1024
+MAX_REPORTED_IMPORT_ERRORS = 1000
+
+def iter_ndjson(stream):
+    """Yield (line_number, record, error) for each non-blank line of an NDJSON stream.
+
+    Lines are read with a length limit, so an over-long line is reported and
+    skipped without ever being held in memory whole.
+    """
+    line_number = 0
+    while True:
+        raw_line = stream.readline(MAX_IMPORT_RECORD_CHARS + 1)
+        if not raw_line:
+            return
+        line_number += 1
+        if len(raw_line) > MAX_IMPORT_RECORD_CHARS and not raw_line.endswith(b'\n'):
+            # Drop the rest of the line in bounded pieces
+            while raw_line and not raw_line.endswith(b'\n'):
+                raw_line = stream.readline(MAX_IMPORT_RECORD_CHARS + 1)
+            yield line_number, None, f'Record longer than {MAX_IMPORT_RECORD_CHARS} characters'
+            continue
+        raw_line = raw_line.strip()
+        if not raw_line:
+            continue
+        try:
+            yield line_number, json.loads(raw_line), None
+        except ValueError as e:
+            yield line_number, None, f'Invalid JSON: {e}'
+
+def iter_json_array(stream, chunk_size=64 * 1024):
+    """Yield (index, record, None) for each element of a JSON array read in chunks.
+
+    Only the element currently being decoded is buffered. Raises ValueError when
+    the body is not a well-formed array, since there is no way to resync after a
+    broken element.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer, pos, eof = '', 0, False
+    started = False
+    index = 0
+
+    def read_more():
+        nonlocal buffer, pos, eof
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        # Drop the already consumed prefix before appending the next chunk
+        buffer = buffer[pos:] + text_decoder.decode(chunk, final=eof)
+        pos = 0
+
+    while True:
+        while pos < len(buffer) and (buffer[pos].isspace() or (started and buffer[pos] == ',')):
+            pos += 1
+
+        if pos >= len(buffer):
+            if eof:
+                raise ValueError('Unexpected end of JSON array')
+            read_more()
+            continue
+
+        if not started:
+            if buffer[pos] != '[':
+                raise ValueError('Expected a JSON array or NDJSON body')
+            started = True
+            pos += 1
+            continue
+
+        if buffer[pos] == ']':
+            return
+
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as e:
+            if eof or len(buffer) - pos > MAX_IMPORT_RECORD_CHARS:
+                raise ValueError(f'Invalid JSON in element {index + 1}: {e.msg}')
+            read_more()
+            continue
+
+        if end == len(buffer) and not eof and not isinstance(record, (dict, list, str)):
+            # A bare number or literal may continue in the next chunk
+            read_more()
+            continue
+
+        index += 1
+        pos = end
+        yield index, record, None
+
+def build_imported_activity(user_id, record):
+    """Validate one import record against the Activity schema and build the document."""
+    if not isinstance(record, dict):
+        raise ValidationError('Each record must be a JSON object')
+
+    for field in ['title', 'activity_type', 'description']:
+        if field not in record:
+            raise ValidationError(f'Missing required field: {field}')
+
+    activity = Activity(
+        user=user_id,
+        title=record['title'],
+        activity_type=record['activity_type'],
+        description=record['description'],
+        status=record.get('status', 'ongoing'),
+        source=record.get('source'),
+        skills=record.get('skills', [])
+    )
+    if record.get('activity_id'):
+        activity.activity_id = str(record['activity_id'])
+    if record.get('date'):
+        if not isinstance(record['date'], str):
+            raise ValidationError('date must be an ISO 8601 string')
+        activity.date = parse_date_param(record['date'])
+
+    activity.validate()
+    return activity
+
+@app.route('/api/activities/import', methods=['POST'])
+@jwt_required()
+def import_activities():
+    """Bulk-import activities from an NDJSON or JSON array body.
+
+    The body is read incrementally and written with unordered insert_many
+    batches of IMPORT_BATCH_SIZE, so memory stays flat regardless of size.
+    Invalid records are skipped and reported by line (NDJSON) or element
+    index (JSON array).
+    """
+    summary = {'imported': 0, 'failed': 0, 'errors': []}
+
+    def record_error(position, message):
+        summary['failed'] += 1
+        if len(summary['errors']) < MAX_REPORTED_IMPORT_ERRORS:
+            summary['errors'].append({'line': position, 'error': message})
+
+    def flush(batch):
+        if not batch:
+            return
+        try:
+            Activity._get_collection().insert_many(
+                [activity.to_mongo() for _, activity in batch],
+                ordered=False
+            )
+            summary['imported'] += len(batch)
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            summary['imported'] += len(batch) - len(write_errors)
+            for write_error in write_errors:
+                message = write_error.get('errmsg', 'Write failed')
+                if write_error.get('code') == 11000:
+                    message = 'Duplicate activity_id'
+                record_error(batch[write_error['index']][0], message)
+
+    try:
+        user_id = ObjectId(get_jwt_identity())
+
+        if request.mimetype in ('application/x-ndjson', 'application/jsonl', 'application/jsonlines'):
+            records = iter_ndjson(request.stream)
+        else:
+            records = iter_json_array(request.stream)
+
+        batch = []
+        try:
+            for position, record, error in records:
+                if error:
+                    record_error(position, error)
+                    continue
+                try:
+                    batch.append((position, build_imported_activity(user_id, record)))
+                except (ValidationError, ValueError) as e:
+                    record_error(position, str(e))
+                    continue
+
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    flush(batch)
+                    batch = []
+        except ValueError as e:
+            # The body itself is malformed; keep what was already imported
+            flush(batch)
+            if summary['imported']:
+                bump_activity_version(user_id)
+            return jsonify({**summary, 'error': str(e)}), 400
+
+        flush(batch)
+        if summary['imported']:
+            bump_activity_version(user_id)
+        return jsonify(summary), 200
+
+    except Exception as e:
+        logger.error(f"Error importing activities: {str(e)}")
+        return jsonify({'error': 'Server error', 'details': str(e)}), 500
+
+# One pooled GraphQL client for every LeetCode call; see leetcode_client.py
+leetcode_client = LeetCodeClient(os.getenv('LEETCODE_GRAPHQL_URL', 'https://leetcode.com/graphql'))
+
 @app.route('/api/update_leetcode_data', methods=['POST'])
 @jwt_required()
+@user_fields(only=('leetcode_username',))
 def update_leetcode_data():
     try:
-        user_id = get_jwt_identity()
-        user = User.objects(id=user_id).first()
+        user = load_current_user()
         if not user:
             return jsonify({'error': 'User not found'}), 404
 
@@ -407,44 +1103,8 @@ def update_leetcode_data():
         if not leetcode_username:
             return jsonify({'error': 'LeetCode username not set'}), 400
 
-        # GraphQL Setup with fetch_schema_from_transport=False as suggested
-        transport = RequestsHTTPTransport(
-            url='https://leetcode.com/graphql',
-            verify=True,
-            retries=3,
-        )
-        client = Client(
-            transport=transport,
-            fetch_schema_from_transport=False
-        )
-
-        # Updated GraphQL Query that works with current LeetCode API
-        query = gql("""
-            query getUserProfile($username: String!) {
-                allQuestionsCount {
-                    difficulty
-                    count
-                }
-                matchedUser(username: $username) {
-                    username
-                    submitStats: submitStatsGlobal {
-                        acSubmissionNum {
-                            difficulty
-                            count
-                        }
-                    }
-                    profile {
-                        ranking
-                        reputation
-                        starRating
-                    }
-                }
-            }
-        """)
-
         # Execute GraphQL query
-        variables = {"username": leetcode_username}
-        result = client.execute(query, variable_values=variables)
+        result = leetcode_client.execute(USER_PROFILE_QUERY, username=leetcode_username)
 
         if not result or 'matchedUser' not in result:
             return jsonify({'error': 'User not found on LeetCode'}), 404
@@ -463,17 +1123,18 @@ def update_leetcode_data():
 
         # Create new activity for LeetCode update
         new_activity = Activity(
+            user=user,
             title=f"LeetCode Update for {leetcode_username}",
             activity_type='LeetCode Update',
             description=f"Solved Problems: {solved_problems}",
             date=datetime.utcnow(),
             status='completed',
-            leetcode_rating=matched_user.get('profile', {}).get('ranking', 0),
+            source='leetcode',
             skills=[]  # Clear skills for new update
         )
 
-        user.activities.append(new_activity)
-        user.save()
+        new_activity.save()
+        bump_activity_version(user.id)
 
         return jsonify({
             'message': 'LeetCode data updated successfully',
@@ -498,13 +1159,9 @@ def set_leetcode_username():
             
         leetcode_username = data['leetcode_username']
         
-        # Update user's LeetCode username
-        user = User.objects(id=user_id).first()
-        if not user:
+        # Update user's LeetCode username without loading the user
+        if not User.objects(id=user_id).update_one(set__leetcode_username=leetcode_username):
             return jsonify({'error': 'User not found'}), 404
-            
-        user.leetcode_username = leetcode_username
-        user.save()
         
         return jsonify({
             'message': 'LeetCode username set successfully',
@@ -520,7 +1177,7 @@ def set_leetcode_username():
 def get_leetcode_status(username):
     try:
         # Find user by username
-        user = User.objects(username=username).first()
+        user = User.objects(username=username).only('leetcode_username').first()
         if not user:
             return jsonify({'error': 'User not found'}), 404
 
@@ -545,7 +1202,7 @@ def get_leetcode_status(username):
 def get_leetcode_history(username):
     try:
         # Find user by username
-        user = User.objects(username=username).first()
+        user = User.objects(username=username).only('leetcode_username').first()
         if not user:
             return jsonify({'error': 'User not found'}), 404
 
@@ -556,49 +1213,9 @@ def get_leetcode_history(username):
                 'needs_setup': True
             }), 400
 
-        # GraphQL Setup
-        transport = RequestsHTTPTransport(
-            url='https://leetcode.com/graphql',
-            verify=True,
-            retries=3,
-        )
-        client = Client(
-            transport=transport,
-            fetch_schema_from_transport=False
-        )
-
-        # Get user profile and submission stats
-        profile_query = gql("""
-            query getUserProfile($username: String!) {
-                matchedUser(username: $username) {
-                    submitStats: submitStatsGlobal {
-                        acSubmissionNum {
-                            difficulty
-                            count
-                        }
-                    }
-                }
-            }
-        """)
-
-        # Get contest history - simplified
-        contest_query = gql("""
-            query getUserContestInfo($username: String!) {
-                userContestRankingHistory(username: $username) {
-                    attended
-                    rating
-                    ranking
-                    contest {
-                        title
-                        startTime
-                    }
-                }
-            }
-        """)
-
-        # Execute both queries
-        profile_result = client.execute(profile_query, variable_values={"username": user.leetcode_username})
-        contest_result = client.execute(contest_query, variable_values={"username": user.leetcode_username})
+        # Get user profile and submission stats, then contest history
+        profile_result = leetcode_client.execute(SUBMIT_STATS_QUERY, username=user.leetcode_username)
+        contest_result = leetcode_client.execute(CONTEST_HISTORY_QUERY, username=user.leetcode_username)
 
         if not profile_result.get('matchedUser'):
             return jsonify({'error': 'LeetCode user not found'}), 404
@@ -642,7 +1259,7 @@ def get_leetcode_history(username):
 def set_user_leetcode_username(username):
     try:
         current_user_id = get_jwt_identity()
-        user = User.objects(username=username).first()
+        user = User.objects(username=username).only('id').first()
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
@@ -658,33 +1275,14 @@ def set_user_leetcode_username(username):
         leetcode_username = data['leetcode_username']
 
         # Verify the LeetCode username exists by making a test query
-        transport = RequestsHTTPTransport(
-            url='https://leetcode.com/graphql',
-            verify=True,
-            retries=3,
-        )
-        client = Client(
-            transport=transport,
-            fetch_schema_from_transport=False
-        )
-
-        test_query = gql("""
-            query testUser($username: String!) {
-                matchedUser(username: $username) {
-                    username
-                }
-            }
-        """)
-
         try:
-            result = client.execute(test_query, variable_values={"username": leetcode_username})
+            result = leetcode_client.execute(USERNAME_QUERY, username=leetcode_username)
             if not result or not result.get('matchedUser'):
                 return jsonify({'error': 'Invalid LeetCode username'}), 400
         except Exception as e:
             return jsonify({'error': 'Could not verify LeetCode username'}), 400
             
-        user.leetcode_username = leetcode_username
-        user.save()
+        user.update(set__leetcode_username=leetcode_username)
         
         return jsonify({
             'message': 'LeetCode username set successfully',
@@ -697,10 +1295,12 @@ def set_user_leetcode_username(username):
 
 @app.route('/api/user/profile', methods=['GET'])
 @jwt_required()
+@conditional_get
+@user_fields(only=('name', 'bio', 'location', 'github', 'linkedin', 'skills',
+                   'profile_image_hash', 'education', 'experience'))
 def get_profile():
     try:
-        user_id = get_jwt_identity()
-        user = User.objects(id=user_id).first()
+        user = load_current_user()
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
@@ -712,7 +1312,7 @@ def get_profile():
             'github': user.github,
             'linkedin': user.linkedin,
             'skills': user.skills,
-            'profile_image': user.profile_image,
+            'profile_image': profile_image_base64(user, 'avatar'),
             'education': [{
                 'school': edu.school,
                 'degree': edu.degree,
@@ -743,24 +1343,18 @@ def get_profile():
 def update_profile():
     try:
         user_id = get_jwt_identity()
-        user = User.objects(id=user_id).first()
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-
         data = request.get_json()
         
-        # Update basic info
-        user.name = data.get('name', user.name)
-        user.bio = data.get('bio', user.bio)
-        user.location = data.get('location', user.location)
-        user.github = data.get('github', user.github)
-        user.linkedin = data.get('linkedin', user.linkedin)
-        user.skills = data.get('skills', user.skills)
+        # Update basic info, only for the fields that were sent
+        updates = {}
+        for field in ['name', 'bio', 'location', 'github', 'linkedin', 'skills']:
+            if field in data:
+                User._fields[field].validate(data[field])
+                updates[f'set__{field}'] = data[field]
 
         # Update education
         if 'education' in data:
-            user.education = []
+            education_list = []
             for edu_data in data['education']:
                 # Validate required fields
                 required_fields = ['school', 'degree', 'field', 'start_year']
@@ -778,11 +1372,12 @@ def update_profile():
                     current=edu_data.get('current', False),
                     description=edu_data.get('description', '')
                 )
-                user.education.append(education)
+                education_list.append(education)
+            updates['set__education'] = education_list
 
         # Update experience
         if 'experience' in data:
-            user.experience = []
+            experience_list = []
             for exp_data in data['experience']:
                 # Validate required fields
                 required_fields = ['company', 'position', 'start_date']
@@ -799,7 +1394,8 @@ def update_profile():
                     current=exp_data.get('current', False),
                     description=exp_data.get('description', '')
                 )
-                user.experience.append(experience)
+                experience_list.append(experience)
+            updates['set__experience'] = experience_list
 
         # Check if a new profile image is provided
         if 'profile_image' in request.files:
@@ -808,154 +1404,315 @@ def update_profile():
             if image_response.status_code != 200:
                 return image_response
 
-        user.save()
+        # Apply everything in a single $set instead of loading and saving the user
+        if updates:
+            updated = User.objects(id=user_id).update_one(**updates)
+            if updated:
+                bump_data_version(user_id, profile=True)
+        else:
+            updated = User.objects(id=user_id).count()
+        if not updated:
+            return jsonify({'error': 'User not found'}), 404
+
         return jsonify({'message': 'Profile updated successfully'}), 200
         
+    except ValidationError as e:
+        return jsonify({'error': 'Invalid profile data', 'details': str(e)}), 400
     except Exception as e:
         logger.error(f"Error updating profile: {str(e)}")
         return jsonify({'error': 'Server error', 'details': str(e)}), 500
 
-def generate_resume_content(resume_data):
-    try:
-        # Format education entries with proper defaults
-        education_entries = []
-        for edu in resume_data.get('education', []):
-            education_entries.append({
-                "degree": edu.get('degree', ''),
-                "field": edu.get('field', ''),
-                "school": edu.get('school', ''),
-                "start_year": edu.get('start_year', ''),
-                "end_year": edu.get('end_year', 'Present'),
-                "description": edu.get('description', '')
-            })
+# Upper bound on the user data part of a prompt, and on each free-text field in it
+PROMPT_TOKEN_BUDGET = int(os.getenv('LLM_PROMPT_BUDGET', 1500))
+PROMPT_DESCRIPTION_CHARS = int(os.getenv('LLM_DESCRIPTION_CHARS', 300))
+JOB_DESCRIPTION_CHARS = 2000
+
+# Generated and memoized one at a time, in this order
+RESUME_SECTIONS = ('basics', 'education', 'experience', 'skills', 'projects')
+
+def resume_prompt_input(resume_data):
+    """Compact resume_data into the per-section model input. Returns (input_data, budgets).
+
+    Each section is its own prompt. Only `projects` is cut to fit, with its
+    own PromptBudget in `budgets`; the other sections are always sent in full.
+    """
+    user_info = resume_data['user_info']
+    basics = {
+        "name": user_info['name'],
+        "email": user_info['email'],
+        "location": user_info.get('location', ''),
+        "profiles": {
+            "github": user_info.get('github', ''),
+            "linkedin": user_info.get('linkedin', '')
+        },
+        "summary": truncate_text(user_info.get('bio', ''), PROMPT_DESCRIPTION_CHARS)
+    }
 
-        # Format experience entries with proper defaults
-        experience_entries = []
-        for exp in resume_data.get('experience', []):
-            experience_entries.append({
-                "position": exp.get('position', ''),
-                "company": exp.get('company', ''),
-                "start_date": exp.get('start_date', ''),
-                "end_date": exp.get('end_date', 'Present'),
-                "description": exp.get('description', '')
-            })
+    skills = []
+    for skill in resume_data.get('skills', []):
+        if skill and skill.strip().lower() not in {s.lower() for s in skills}:
+            skills.append(skill.strip())
+
+    # Format experience entries with proper defaults
+    experience_entries = dedupe([{
+        "position": exp.get('position', ''),
+        "company": exp.get('company', ''),
+        "start_date": exp.get('start_date', ''),
+        "end_date": exp.get('end_date', 'Present'),
+        "description": truncate_text(exp.get('description', ''), PROMPT_DESCRIPTION_CHARS)
+    } for exp in resume_data.get('experience', [])], ('position', 'company', 'start_date'))
+
+    # Format education entries with proper defaults
+    education_entries = dedupe([{
+        "degree": edu.get('degree', ''),
+        "field": edu.get('field', ''),
+        "school": edu.get('school', ''),
+        "start_year": edu.get('start_year', ''),
+        "end_year": edu.get('end_year', 'Present'),
+        "description": truncate_text(edu.get('description', ''), PROMPT_DESCRIPTION_CHARS)
+    } for edu in resume_data.get('education', [])], ('degree', 'field', 'school'))
+
+    # Activities that match the target job first, then the most recent, as far as they fit
+    projects_budget = PromptBudget(PROMPT_TOKEN_BUDGET)
+    activity_entries = projects_budget.fit(rank_by_relevance(dedupe([{
+        "title": act.get('title', ''),
+        "description": truncate_text(act.get('description', ''), PROMPT_DESCRIPTION_CHARS),
+        "skills": act.get('skills', []),
+        "date": str(act.get('date') or '')[:10]
+    } for act in resume_data.get('activities', [])], ('title', 'description')),
+        f"{resume_data.get('job_title', '')} {resume_data.get('job_description', '')}",
+        ('title', 'description', 'skills'), 'date'))
+
+    input_data = {
+        "basics": basics,
+        "education": education_entries,
+        "experience": experience_entries,
+        "skills": skills,
+        "projects": activity_entries
+    }
 
-        # Format activities with explicit defaults
-        activity_entries = []
-        for act in resume_data.get('activities', []):
-            activity_entries.append({
-                "title": act.get('title', ''),
-                "description": act.get('description', ''),
-                "skills": act.get('skills', []),
-                "date": act.get('date', '')
-            })
-        print(resume_data)
-
-        # Enhanced prompt with explicit structure example
-        prompt = f"""Create a professional resume in JSON format with these sections:
-        1. basics (must include name, email)
-        2. education
-        3. experience 
-        4. skills
-        5. projects
-        
-        Input Data:
-        {{
-            "basics": {{
-                "name": "{resume_data['user_info']['name']}",
-                "email": "{resume_data['user_info']['email']}",
-                "location": "{resume_data['user_info'].get('location', '')}",
-                "profiles": {{
-                    "github": "{resume_data['user_info'].get('github', '')}",
-                    "linkedin": "{resume_data['user_info'].get('linkedin', '')}"
-                }},
-                "summary": "{resume_data['user_info'].get('bio', '')}"
-            }},
-            "education": {education_entries},
-            "experience": {experience_entries},
-            "skills": {resume_data.get('skills', [])},
-            "projects": {activity_entries}
-        }}
-        
-        Requirements:
-        1. Maintain this exact structure as shown in the input data  i repeat.
-        2. Improve wording but keep all original data
-        3. Output must be valid JSON without markdown
-        4. Never omit the basics section
-        5. For dates and periods:
+    return input_data, {'projects': projects_budget}
+
+def build_resume_section_prompt(name, value, job_description=''):
+    prompt = f"""Rewrite the "{name}" section of a professional resume.
+    
+    Input Data:
+    {compact_json({name: value})}
+    
+    Requirements:
+    1. Return a JSON object with the single key "{name}" and the same structure as the input data
+    2. Improve wording but keep all original data
+    3. Output must be valid JSON without markdown
+    4. For dates and periods:
    - Use consistent format: YYYY-MM for all dates
    - For ongoing items, use 'Present' consistently"""
-        if resume_data.get('job_description'):
-            prompt += f"""
-            
-            Job Requirements to Align With:
-            {resume_data['job_description']}
-            
-            Customization Instructions:
-            6. Highlight skills matching the job description
-            7. Emphasize relevant experience
-            8. Use keywords from the job requirements
-            9. Maintain original data integrity
-            10.for projects give a tleast 2 lines.
-            """
-        print(prompt)    
-        
-   
-
-        # Generate content - fix indentation here
-        response = requests.post(
-            "http://localhost:11434/api/generate",
-            json={
-                "model": "mistral",
-                "prompt": prompt,
-                "stream": False,
-                "options": {
-                    "temperature": 0.7,
-                    "max_tokens": 2000
-                }
-            },
-            timeout=60
-        )
-        
-        response.raise_for_status()  # Check for HTTP errors
-        response_data = response.json()
+    if name == 'basics':
+        prompt += """
+    5. Never omit the name and email"""
+    if job_description:
+        prompt += f"""
         
-        # Clean response text
-        content = response_data.get("response", "")
-        
-        # Extract only the JSON content between first { and last }
-        start_idx = content.find('{')
-        end_idx = content.rfind('}') + 1  # +1 to include the closing brace
-        
-        if start_idx == -1 or end_idx == -1:
-            raise ValueError("No valid JSON found in response")
-            
-        clean_content = content[start_idx:end_idx]
+        Job Requirements to Align With:
+        {job_description}
         
-        # Remove any remaining markdown formatting
-        clean_content = re.sub(r'```json|```', '', clean_content)
-        clean_content = clean_content.strip()
-            
-        parsed_resume=clean_content
-        # print("thisss is the thinggg")
-        # # parsed_resume="'''"+parsed_resume+"'''"
-        # print(parsed_resume)    
-        parsed_resume=json.loads(parsed_resume)
-        parsed_resume=json.dumps(parsed_resume, indent=4)
-        return parsed_resume
-    except Exception as e:
-        return Exception(" error in parsing resume")
-    
-def generate_cover_letter_content(job_description, user_data, tone='professional', user_api_key=None):
-    """Generate cover letter using Gemini with job description context"""
+        Customization Instructions:
+        - Highlight skills matching the job description
+        - Emphasize relevant experience
+        - Use keywords from the job requirements
+        - Maintain original data integrity"""
+        if name == 'projects':
+            prompt += """
+        - For projects give at least 2 lines"""
+    return prompt
+
+# Sampling options for resume generation
+RESUME_OPTIONS = {
+    "temperature": 0.7,
+    "max_tokens": 2000
+}
+
+def resume_section_key(name, value, job_description):
+    # Everything the section's prompt is built from, so unchanged inputs reuse the stored section
+    material = compact_json(['resume-section', ollama.model, RESUME_OPTIONS, name, value, job_description])
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+# Shape each generated section must have before it is stored or returned
+RESUME_SECTION_SCHEMAS = {
+    'basics': {'name': str, 'email': str},
+    'education': [dict],
+    'experience': [dict],
+    'skills': [str],
+    'projects': [dict],
+}
+
+def unwrap_resume_section(name):
+    def unwrap(value):
+        # Asked for {"<name>": ...}, but models also return the bare value
+        if isinstance(value, dict) and name in value:
+            return value[name]
+        if isinstance(value, dict) and len(value) == 1 and name != 'basics':
+            return next(iter(value.values()))
+        return value
+    return unwrap
+
+def generate_resume_section(name, value, job_description, fresh=False, deadline=None, budget=None):
+    """Return the generated section, reusing the stored one if its inputs have not changed."""
+    key = resume_section_key(name, value, job_description)
+    if not fresh:
+        cached = llm_cache.get(key)
+        if cached is not None:
+            return json.loads(cached)
+
+    prompt = build_resume_section_prompt(name, value, job_description)
+    log_prompt(f'Resume {name}', prompt, budget)
+    content = generate_json(prompt, RESUME_OPTIONS, RESUME_SECTION_SCHEMAS[name],
+                            unwrap=unwrap_resume_section(name), fresh=fresh, deadline=deadline)
+    llm_cache.set(key, json.dumps(content))
+    return content
+
+def iter_resume_sections(resume_data, fresh=False, deadline=None):
+    """Yield (name, content) per resume section; only sections whose inputs changed hit the model.
+
+    Sections are generated one after another, each holding an LLM slot only
+    for its own call, so a resume never takes more than one slot at a time.
+    Sections finished before a failure are kept, and the retry skips them.
+    """
+    input_data, budgets = resume_prompt_input(resume_data)
+    job_description = truncate_text(resume_data.get('job_description', ''), JOB_DESCRIPTION_CHARS)
+    for name in RESUME_SECTIONS:
+        yield name, generate_resume_section(name, input_data[name], job_description,
+                                            fresh=fresh, deadline=deadline, budget=budgets.get(name))
+
+def generate_resume_content(resume_data, fresh=False, deadline=None):
+    """Return the generated resume as a dict. Raises LLMOutputError if a section stays invalid."""
+    return dict(iter_resume_sections(resume_data, fresh=fresh, deadline=deadline))
+
+# Completed generations keyed by (model, options, prompt); see llm_cache.py
+llm_cache = create_llm_cache(
+    backend=os.getenv('LLM_CACHE_BACKEND', 'mongo'),
+    get_collection=lambda: get_db()['llm_cache'],
+    directory=os.getenv('LLM_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'llm_cache')),
+    max_entries=int(os.getenv('LLM_CACHE_SIZE', 5000)),
+    ttl=int(os.getenv('LLM_CACHE_TTL', 7 * 24 * 3600)),
+    logger=logger
+)
+
+# One pooled client for every generation; see llm_client.py
+ollama = OllamaClient(
+    os.getenv('OLLAMA_URLS', os.getenv('OLLAMA_URL', 'http://localhost:11434')).split(','),
+    cache=llm_cache,
+    max_in_flight=int(os.getenv('LLM_MAX_IN_FLIGHT', 2)),
+    queue_timeout=float(os.getenv('LLM_QUEUE_TIMEOUT', 5)),
+    probe_interval=float(os.getenv('LLM_PROBE_INTERVAL', 15)),
+    hedge=os.getenv('LLM_HEDGE') or None,  # 'p95' or a delay in seconds
+    keep_alive=os.getenv('LLM_KEEP_ALIVE', '30m'),
+    warm_models=[m for m in os.getenv('LLM_WARM_MODELS', 'mistral').split(',') if m],
+    keep_warm_interval=float(os.getenv('LLM_KEEP_WARM_INTERVAL', 600))
+)
+
+# Repair prompts sent for output that is not valid JSON of the expected shape
+MAX_OUTPUT_REPAIRS = 2
+
+def build_repair_prompt(output, problems):
+    return f"""This output was supposed to be valid JSON but has these problems:
+    {'; '.join(problems[:10])}
+
+    Output:
+    {output[:4000]}
+
+    Return ONLY the corrected JSON, with no extra text or markdown."""
+
+def generate_json(prompt, options, schema, unwrap=None, fresh=False, deadline=None):
+    """Generate with `prompt` and return the JSON in the answer, checked against `schema`.
+
+    Invalid answers are dropped from llm_cache and get up to
+    MAX_OUTPUT_REPAIRS repair prompts. Raises LLMOutputError if none is valid.
+    """
+    output = ollama.generate(prompt, options, fresh=fresh, deadline=deadline)
+    for attempt in range(MAX_OUTPUT_REPAIRS + 1):
+        try:
+            value = extract_json(output)
+            if unwrap:
+                value = unwrap(value)
+            problems = validate(value, schema)
+        except LLMOutputError as e:
+            problems = [str(e)]
+        if not problems:
+            return value
+
+        llm_cache.delete(ollama.cache_key(prompt, options))
+        if attempt == MAX_OUTPUT_REPAIRS:
+            break
+        logger.warning(f"Invalid model output, asking for a repair: {'; '.join(problems[:3])}")
+        prompt = build_repair_prompt(output, problems)
+        output = ollama.generate(prompt, options, fresh=fresh, deadline=deadline)
+
+    raise LLMOutputError(f"Invalid model output: {'; '.join(problems[:3])}")
+
+def llm_busy_response(error):
+    response = jsonify({'error': 'Text generation is busy, please retry shortly'})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 503
+
+# Longest a request may keep the model busy; clients can ask for less with X-Request-Timeout
+LLM_REQUEST_DEADLINE = float(os.getenv('LLM_REQUEST_DEADLINE', 300))
+
+def socket_closed(sock):
+    # The request body has already been read, so readable with nothing to peek means the client left
     try:
-        # API key handling same as resume generation
-        
-        
-        prompt = f"""Generate a professional cover letter based on this job description and applicant profile.
+        readable, _, _ = select.select([sock], [], [], 0)
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+    except ConnectionError:
+        return True
+    except (OSError, ValueError):
+        return False
+
+def request_deadline():
+    """Deadline for the generations made while serving this request.
+
+    Ends after LLM_REQUEST_DEADLINE seconds (or the client's shorter
+    `X-Request-Timeout`), or as soon as the client disconnects when the
+    server exposes the connection's socket.
+    """
+    seconds = LLM_REQUEST_DEADLINE
+    try:
+        seconds = min(seconds, float(request.headers.get('X-Request-Timeout', seconds)))
+    except ValueError:
+        pass
+    sock = request.environ.get('werkzeug.socket') or request.environ.get('gunicorn.socket')
+    return Deadline(seconds, disconnected=(lambda: socket_closed(sock)) if sock else None)
+
+def deadline_response():
+    return jsonify({'error': 'Generation took too long and was stopped'}), 504
+
+def sse_event(event, data):
+    """Format one Server-Sent Events message with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def wants_event_stream():
+    return (request.args.get('stream') in ('1', 'true')
+            or request.accept_mimetypes.best == 'text/event-stream')
+
+def wants_fresh():
+    # ?fresh=1 or `Cache-Control: no-cache` regenerates instead of using llm_cache
+    return (request.args.get('fresh') in ('1', 'true')
+            or 'no-cache' in request.headers.get('Cache-Control', ''))
+
+def wants_async():
+    # ?async=1 or the standard `Prefer: respond-async` header
+    return (request.args.get('async') in ('1', 'true')
+            or 'respond-async' in request.headers.get('Prefer', ''))
+
+COVER_LETTER_OPTIONS = {
+    "temperature": 0.7,
+    "max_tokens": 2000
+}
+
+def build_cover_letter_prompt(job_description, user_data, tone='professional'):
+    prompt = f"""Generate a professional cover letter based on this job description and applicant profile.
         
         Job Description:
-        {job_description}
+        {truncate_text(job_description, JOB_DESCRIPTION_CHARS)}
 
         Applicant Profile:
         - Name: {user_data['name']}
@@ -972,68 +1729,109 @@ def generate_cover_letter_content(job_description, user_data, tone='professional
         5. Use proper business letter format
         
         """
-        print(prompt)
-        response = requests.post(
-            "http://localhost:11434/api/generate",
-            json={
-                "model": "mistral",
-                "prompt": prompt,
-                "stream": False,
-                "options": {
-                    "temperature": 0.7,
-                    "max_tokens": 2000
-                }
-            },
-            timeout=60
-        )
-        response_data = response.json()
-        
+    log_prompt('Cover letter', prompt)
+    return prompt
+
+def generate_cover_letter_content(job_description, user_data, tone='professional', fresh=False, deadline=None):
+    """Generate cover letter using Gemini with job description context"""
+    try:
+        prompt = build_cover_letter_prompt(job_description, user_data, tone)
+
         # Clean response text
-        content = response_data.get("response", "")
+        content = ollama.generate(prompt, COVER_LETTER_OPTIONS, fresh=fresh, deadline=deadline)
         return content
 
     except Exception as e:
         logger.error(f"Cover letter generation error: {str(e)}")
         raise
 
+def stream_cover_letter(prompt, fresh=False, deadline=None):
+    """Forward Ollama's token stream to the client as Server-Sent Events.
+
+    Emits `token` events, then `done` (or `error`). If the client goes away
+    the WSGI server closes this generator, which closes the Ollama request.
+    Raises LLMBusyError before the response starts if no slot is free.
+    """
+    tokens = ollama.stream(prompt, COVER_LETTER_OPTIONS, fresh=fresh, deadline=deadline)
+
+    def events():
+        try:
+            for token in tokens:
+                yield sse_event('token', {'token': token})
+            yield sse_event('done', {'generated_at': datetime.now().isoformat()})
+        except Exception as e:
+            logger.error(f"Cover letter stream error: {str(e)}")
+            yield sse_event('error', {'error': 'Cover letter generation failed'})
+        finally:
+            tokens.close()
+
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+COVER_LETTER_USER_FIELDS = ('name', 'education', 'experience', 'skills')
+
+def cover_letter_user_data(user):
+    # Prepare user data (removed activities filtering)
+    return {
+        'name': user.name,
+        'education': user.education,
+        'experience': user.experience,
+        'skills': user.skills
+    }
+
+def cover_letter_result(user, data, deadline=None):
+    """Generate a cover letter for `user`; returns (body, status) for the route or a job."""
+    cover_letter = generate_cover_letter_content(
+        job_description=data['job_description'],
+        user_data=cover_letter_user_data(user),
+        tone=data['tone'],
+        fresh=data.get('fresh', False),
+        deadline=deadline
+    )
+
+    return {
+        'cover_letter': cover_letter,
+        'generated_at': datetime.now().isoformat()
+    }, 200
+
 @app.route('/api/cover_letter/generate', methods=['POST'])
 @jwt_required()
+@user_fields(only=COVER_LETTER_USER_FIELDS)
 def generate_cover_letter():
     try:
         data = request.get_json(force=True)
         required_fields = ['job_description', 'tone']
         if not all(field in data for field in required_fields):
             return jsonify({'error': 'Missing required fields'}), 400
-        
-        user_id = get_jwt_identity()
-        user = User.objects(id=user_id).first()
+
+        if wants_fresh():
+            data['fresh'] = True
+
+        if wants_async():
+            return submit_generation_job('cover_letter', get_jwt_identity(), data)
+
+        user = load_current_user()
         
         if not user:
             return jsonify({'error': 'User not found'}), 404
 
-        # Prepare user data (removed activities filtering)
-        user_data = {
-            'name': user.name,
-            'education': user.education,
-            'experience': user.experience,
-            'skills': user.skills,
-            'activities':user.activities
-        }
-
-        # Generate cover letter
-        cover_letter = generate_cover_letter_content(
-            job_description=data['job_description'],
-            user_data=user_data,
-            tone=data['tone'],
-            user_api_key=user.gemini_api_key
-        )
-        
+        if wants_event_stream():
+            return stream_cover_letter(
+                build_cover_letter_prompt(data['job_description'], cover_letter_user_data(user), data['tone']),
+                fresh=wants_fresh(),
+                deadline=request_deadline()
+            )
 
-        return jsonify({
-            'cover_letter': cover_letter,
-            'generated_at': datetime.now().isoformat()
-        }), 200
+        body, status = cover_letter_result(user, data, deadline=request_deadline())
+        return jsonify(body), status
 
+    except LLMBusyError as e:
+        return llm_busy_response(e)
+    except DeadlineExceeded:
+        return deadline_response()
     except Exception as e:
         logger.error(f"Cover letter error: {str(e)}")
         error_msg = 'Cover letter generation failed'
@@ -1041,87 +1839,173 @@ def generate_cover_letter():
             error_msg += ' - Invalid API key'
         return jsonify({'error': error_msg}), 500
 
-@app.route('/api/resume/generate', methods=['POST'])
-@jwt_required()
-def generate_resume():
+def stream_resume(resume, resume_data, profile_image, fresh=False, deadline=None):
+    """Stream resume generation as Server-Sent Events, one section at a time.
+
+    Sends `start` with the resume id and input data, a `section` event as soon
+    as each section (basics, education, ...) is available, unchanged sections
+    coming straight from the memo, then `done` with the full document once it
+    is saved on the Resume, or `error`.
+    """
+    def events():
+        yield sse_event('start', {'resume_id': str(resume.id), 'resume_data': resume_data})
+
+        resume_json = {}
+        try:
+            for name, content in iter_resume_sections(resume_data, fresh=fresh, deadline=deadline):
+                resume_json[name] = content
+                yield sse_event('section', {'name': name, 'content': content})
+
+            # Add profile image after generation to avoid sending the image data to the model
+            if profile_image:
+                resume_json['profile_image'] = profile_image
+            resume.generated_content = json.dumps(resume_json)
+            resume.save()
+
+            yield sse_event('done', {
+                'resume_id': str(resume.id),
+                'generated_content': resume.generated_content
+            })
+        except LLMBusyError as e:
+            discard_resume(resume)
+            yield sse_event('error', {'error': 'Text generation is busy, please retry shortly',
+                                      'retry_after': e.retry_after})
+        except DeadlineExceeded:
+            discard_resume(resume)
+            yield sse_event('error', {'error': 'Generation took too long and was stopped'})
+        except Exception as e:
+            logger.error(f"Resume stream error: {str(e)}")
+            discard_resume(resume)
+            yield sse_event('error', {'error': 'Resume generation failed'})
+
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+RESUME_USER_FIELDS = ('name', 'email', 'location', 'bio', 'github', 'linkedin',
+                      'profile_image_hash', 'education', 'experience', 'skills')
+
+def resume_input_data(user, data, profile_image=None):
+    """Collect the profile, activities and target job a resume for `user` is generated from."""
+    # Convert datetime objects before serialization
+    def convert_dates(activity):
+        activity_dict = activity.to_mongo().to_dict()
+        for key in ['date']:
+            if key in activity_dict and isinstance(activity_dict[key], datetime):
+                activity_dict[key] = activity_dict[key].isoformat()
+        return activity_dict
+
+    # Prepare resume data with activities
+    return {
+        'user_info': {
+            'name': user.name,
+            'email': user.email,
+            'location': user.location,
+            'bio': user.bio,
+            'github': user.github,
+            'linkedin': user.linkedin,
+            'profile_image': profile_image
+        },
+        'education': [convert_dates(edu) for edu in user.education],
+        'experience': [convert_dates(exp) for exp in user.experience],
+        'skills': user.skills,
+        'activities': [convert_dates(act) for act in Activity.objects(user=user).exclude('id', 'user')],
+        'job_title': data.get('job_title', ''),
+        'job_description': data.get('job_description', '')
+    }
+
+def prepare_resume(user, data):
+    """Create the Resume document and collect the data it is generated from.
+
+    Returns (resume, resume_data, profile_image).
+    """
+    # Create new resume document
+    resume = Resume(
+        user=user,
+        template_id=data['template'],
+        type=data['type'],
+        job_title=data.get('job_title', ''),
+        created_at=datetime.utcnow()
+    )
+    resume.save()
+    bump_data_version(user.id)
+
+    profile_image = profile_image_base64(user, 'resume')
+    return resume, resume_input_data(user, data, profile_image), profile_image
+
+def discard_resume(resume):
+    # Generation failed or was stopped, so do not leave an empty resume behind
+    resume.delete()
+    bump_data_version(resume.user.id)
+
+def complete_resume(resume, resume_data, profile_image, fresh=False, deadline=None):
+    """Generate and store the resume content; returns (body, status) for the route or a job."""
     try:
-        # Convert datetime objects before serialization
-        def convert_dates(activity):
-            activity_dict = activity.to_mongo().to_dict()
-            for key in ['date']:
-                if key in activity_dict and isinstance(activity_dict[key], datetime):
-                    activity_dict[key] = activity_dict[key].isoformat()
-            return activity_dict
+        resume_json = generate_resume_content(
+            resume_data, fresh=fresh, deadline=deadline
+        )
+    except LLMOutputError as e:
+        logger.error(f"Invalid JSON generated: {str(e)}")
+        discard_resume(resume)
+        return {'error': 'Failed to generate valid resume content'}, 500
+    except Exception:
+        # Busy, deadline and request errors are handled by the caller
+        discard_resume(resume)
+        raise
 
-        user_id = get_jwt_identity()
-        user = User.objects(id=user_id).first()
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
+    # Add profile image to resume data if it exists
+    # We add this after Gemini generation to avoid sending the image data to the model
+    if profile_image:
+        resume_json['profile_image'] = profile_image
 
-        # Check for any available API key (user or .env)
-        
+    # Update resume with generated content
+    resume.generated_content = json.dumps(resume_json)
+    resume.save()
+
+    return {
+        'message': 'Resume generated successfully',
+        'resume_id': str(resume.id),
+        'resume_data': resume_data,
+        'generated_content': resume.generated_content,
+    }, 201
 
+@app.route('/api/resume/generate', methods=['POST'])
+@jwt_required()
+@user_fields(only=RESUME_USER_FIELDS)
+def generate_resume():
+    try:
         data = request.get_json()
         required_fields = ['template', 'type']
         if not all(field in data for field in required_fields):
             return jsonify({'error': 'Missing required fields'}), 400
 
-        # Create new resume document
-        resume = Resume(
-            user=user,
-            template_id=data['template'],
-            type=data['type'],
-            job_title=data.get('job_title', ''),
-            created_at=datetime.utcnow()
-        )
-        resume.save()
+        if wants_fresh():
+            data['fresh'] = True
 
-        # Prepare resume data with activities
-        resume_data = {
-            'user_info': {
-                'name': user.name,
-                'email': user.email,
-                'location': user.location,
-                'bio': user.bio,
-                'github': user.github,
-                'linkedin': user.linkedin,
-                'profile_image': user.profile_image
-            },
-            'education': [convert_dates(edu) for edu in user.education],
-            'experience': [convert_dates(exp) for exp in user.experience],
-            'skills': user.skills,
-            'activities': [convert_dates(act) for act in user.activities]
-        }
+        if wants_async():
+            return submit_generation_job('resume', get_jwt_identity(), data)
 
-        # Pass user's API key if available
-        generated_resume = generate_resume_content(
-            resume_data
-        )
+        user = load_current_user()
+        
+        if not user:
+            return jsonify({'error': 'User not found'}), 404
 
-        # Parse the generated content
-        try:
-            resume_json = json.loads(generated_resume)
-            
-            # Add profile image to resume data if it exists
-            # We add this after Gemini generation to avoid sending the image data to the model
-            if user.profile_image:
-                resume_json['profile_image'] = user.profile_image
+        resume, resume_data, profile_image = prepare_resume(user, data)
 
-            # Update resume with generated content
-            resume.generated_content = json.dumps(resume_json)
-            resume.save()
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON generated: {str(e)}")
-            return jsonify({'error': 'Failed to generate valid resume content'}), 500
+        if wants_event_stream():
+            return stream_resume(resume, resume_data, profile_image, fresh=wants_fresh(),
+                                 deadline=request_deadline())
 
-        return jsonify({
-            'message': 'Resume generated successfully',
-            'resume_id': str(resume.id),
-            'resume_data': resume_data,
-            'generated_content': resume.generated_content,
-        }), 201
+        body, status = complete_resume(resume, resume_data, profile_image, fresh=wants_fresh(),
+                                       deadline=request_deadline())
+        return jsonify(body), status
 
+    except LLMBusyError as e:
+        return llm_busy_response(e)
+    except DeadlineExceeded:
+        return deadline_response()
     except Exception as e:
         logger.error(f"Error generating resume: {str(e)}")
         error_msg = 'Resume generation failed'
@@ -1133,15 +2017,14 @@ def generate_resume():
 
 @app.route('/api/resumes', methods=['GET'])
 @jwt_required()
+@conditional_get
 def get_user_resumes():
     try:
         user_id = get_jwt_identity()
-        user = User.objects(id=user_id).first()
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
 
-        resumes = Resume.objects(user=user).order_by('-created_at')
+        resumes = (Resume.objects(user=user_id)
+                   .only('template_id', 'type', 'job_title', 'created_at', 'pdf_url')
+                   .order_by('-created_at'))
         resume_list = [{
             'id': str(resume.id),
             'template_id': resume.template_id,
@@ -1172,18 +2055,13 @@ def add_daily_activity():
 
         # Create new DailyActivity document
         new_activity = DailyActivity(
+            user=ObjectId(user_id),
             title=data['title'],
             description=data['description'],
             skills=data.get('skills', [])
         )
-
-        # Find the user and append the new daily activity
-        user = User.objects(id=user_id).first()
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-
-        user.daily_activities.append(new_activity)
-        user.save()
+        new_activity.save()
+        bump_data_version(user_id)
 
         return jsonify({
             'message': 'Daily activity added successfully',
@@ -1214,24 +2092,39 @@ def upload_profile_image():
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
             
-            # Read the file and convert it to base64
+            # Store only the re-encoded, EXIF-free variants, deduplicated by content hash
             file_data = file.read()
-            encoded_image = base64.b64encode(file_data).decode('utf-8')
+            try:
+                image_hash = render_image_variants(file_data)
+            except UnidentifiedImageError:
+                return jsonify({'error': 'File is not a valid image'}), 400
+            except DecompressionBombError:
+                return jsonify({'error': 'Image dimensions are too large'}), 400
+            content_type = sniff_image_type(file_data, default=file.mimetype)
             
             # Get the user ID from the JWT token
             user_id = get_jwt_identity()
             
-            # Retrieve the user from the database
-            user = User.objects.get(id=user_id)
-            
-            # Update user's profile image in the database
-            user.profile_image = encoded_image
-            user.profile_image_name = filename
-            user.save()
+            # Point the user at the new blob, getting the previous hash back
+            previous = User.objects(id=user_id).only('profile_image_hash').modify(
+                set__profile_image_hash=image_hash,
+                set__profile_image_name=filename,
+                set__profile_image_type=content_type,
+                inc__data_version=1
+            )
+            response_cache.invalidate_user(user_id)
+            if previous is None:
+                image_blob_store.release(image_hash)
+                return jsonify({'error': 'User not found'}), 404
+            # Another user may have released the same image meanwhile; render it again if so
+            image_blob_store.wait_for_release(image_hash)
+            render_image_variants(file_data)
+            if previous.profile_image_hash != image_hash:
+                image_blob_store.release(previous.profile_image_hash)
             
             logger.info(f"User profile image updated successfully")
             
-            return jsonify({'message': 'Profile image uploaded successfully', 'filename': filename, 'base64_image': encoded_image}), 200
+            return jsonify({'message': 'Profile image uploaded successfully', 'filename': filename, 'image_hash': image_hash}), 200
         else:
             return jsonify({'error': 'File type not allowed'}), 400
     except Exception as e:
@@ -1242,14 +2135,19 @@ def upload_profile_image():
 @jwt_required()
 def delete_profile_image():
     try:
-        user = User.objects.get(id=current_user.id)
-        if user.profile_image:
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], user.profile_image)
-            if os.path.exists(file_path):
-                os.remove(file_path)
-            
-            user.profile_image = ''
-            user.save()
+        user_id = get_jwt_identity()
+
+        # Clear the reference first, then drop the blob if nobody else uses it
+        previous = User.objects(id=user_id).only('profile_image_hash').modify(
+            set__profile_image_hash='',
+            set__profile_image_name='',
+            set__profile_image_type='',
+            inc__data_version=1
+        )
+        response_cache.invalidate_user(user_id)
+        if previous is None:
+            return jsonify({'error': 'User not found'}), 404
+        image_blob_store.release(previous.profile_image_hash)
             
         return jsonify({'message': 'Profile image deleted successfully'}), 200
     except Exception as e:
@@ -1277,6 +2175,7 @@ def add_cors_headers(response):
         response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
         response.headers['Access-Control-Allow-Methods'] = 'GET, PUT, POST, DELETE, OPTIONS'
         response.headers['Access-Control-Allow-Credentials'] = 'true'
+        response.headers['Access-Control-Expose-Headers'] = 'X-Next-Cursor'
 
     return response
 @app.route('/api/activities/<activity_id>', methods=['PUT'])
@@ -1284,39 +2183,36 @@ def add_cors_headers(response):
 def update_activity(activity_id):
     try:
         user_id = get_jwt_identity()
-        user = User.objects(id=user_id).first()
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-
         data = request.get_json()
-        
-        # Find the activity index using activity_id
-        activity_index = next(
-            (i for i, a in enumerate(user.activities) if a.activity_id == activity_id),
-            None
-        )
-        
-        if activity_index is None:
-            return jsonify({'error': 'Activity not found'}), 404
 
         # Handle empty skills array
         if 'skills' in data and not data['skills']:
             data['skills'] = []
 
-        # Update allowed fields
-        allowed_fields = ['title', 'description', 'status', 'leetcode_rating', 'skills']
+        # Collect $set operations for the allowed fields
+        allowed_fields = ['title', 'description', 'status', 'skills']
+        updates = {}
         for field in allowed_fields:
             if field in data:
-                setattr(user.activities[activity_index], field, data[field])
+                Activity._fields[field].validate(data[field])
+                updates[f'set__{field}'] = data[field]
 
-        user.save()
+        # Apply the update and read the result back in one findAndModify
+        activities = Activity.objects(user=user_id, activity_id=activity_id)
+        activity = activities.modify(new=True, **updates) if updates else activities.first()
+        
+        if activity is None:
+            return jsonify({'error': 'Activity not found'}), 404
+        if updates:
+            activity_index.upsert(user_id, bump_activity_version(user_id), activity_index_doc(activity))
         
         return jsonify({
             'message': 'Activity updated successfully',
-            'activity': user.activities[activity_index].to_json()
+            'activity': json.dumps(serialize_activity(activity))
         }), 200
 
+    except ValidationError as e:
+        return jsonify({'error': 'Invalid activity data', 'details': str(e)}), 400
     except Exception as e:
         logger.error(f"Error updating activity: {str(e)}")
         return jsonify({'error': 'Server error'}), 500
@@ -1325,21 +2221,42 @@ def update_activity(activity_id):
 
 @app.route('/api/user/profile/image', methods=['GET'])
 @jwt_required()
+@user_fields(only=('profile_image_hash',))
 def get_user_profile_image():
     try:
-        user_id = get_jwt_identity()
-        
         # Get user from database
-        user = User.objects(id=user_id).first()
+        user = load_current_user()
         if not user:
             return jsonify({'error': 'User not found'}), 404
             
         # Get profile image from user
-        if not user.profile_image:
+        if not user.profile_image_hash:
             return jsonify({'error': 'No profile image found'}), 404
+
+        # ?size=avatar|resume|full picks a rendered variant
+        variant = request.args.get('size', 'resume')
+        if variant not in IMAGE_VARIANTS:
+            return jsonify({'error': f'Unknown image size: {variant}'}), 400
+
+        # Blob ids are content hashes, so a matching If-None-Match skips the blob read
+        expected_id = image_blob_store.variant_id(user.profile_image_hash, variant)
+        if expected_id in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(expected_id)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+
+        blob = image_blob_store.get(user.profile_image_hash, variant)
+        if blob is None:
+            return jsonify({'error': 'No profile image found'}), 404
+        data, content_type, blob_id = blob
             
-        # Return the profile image
-        return user.profile_image, 200, {'Content-Type': 'image/jpeg'}
+        # Return the raw image bytes, honouring If-None-Match and Range
+        response = Response(data, mimetype=content_type or 'application/octet-stream')
+        response.set_etag(blob_id)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response.make_conditional(request, accept_ranges=True, complete_length=len(data))
         
     except Exception as e:
         print(f"Error fetching profile image: {str(e)}")
@@ -1351,23 +2268,13 @@ def get_user_profile_image():
 def delete_activity(activity_id):
     try:
         user_id = get_jwt_identity()
-        user = User.objects(id=user_id).first()
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
 
-        # Find the activity index using activity_id
-        activity_index = next(
-            (i for i, a in enumerate(user.activities) if a.activity_id == activity_id),
-            None
-        )
+        # Remove the activity in a single delete scoped to the user
+        deleted = Activity.objects(user=user_id, activity_id=activity_id).delete()
         
-        if activity_index is None:
+        if not deleted:
             return jsonify({'error': 'Activity not found'}), 404
-
-        # Remove the activity from the list
-        user.activities.pop(activity_index)
-        user.save()
+        activity_index.remove(user_id, bump_activity_version(user_id), activity_id)
         
         return jsonify({
             'message': 'Activity deleted successfully'
@@ -1382,23 +2289,13 @@ def delete_activity(activity_id):
 def delete_daily_activity(daily_activity_id):
     try:
         user_id = get_jwt_identity()
-        user = User.objects(id=user_id).first()
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
 
-        # Find the activity index using activity_id
-        daily_activity_index = next(
-            (i for i, a in enumerate(user.daily_activities) if a.daily_activity_id == daily_activity_id),
-            None
-        )
+        # Remove the daily activity in a single delete scoped to the user
+        deleted = DailyActivity.objects(user=user_id, daily_activity_id=daily_activity_id).delete()
         
-        if daily_activity_index is None:
+        if not deleted:
             return jsonify({'error': 'Daily Activity not found'}), 404
-
-        # Remove the activity from the list
-        user.daily_activities.pop(daily_activity_index)
-        user.save()
+        bump_data_version(user_id)
         
         return jsonify({
             'message': 'Daily activity deleted successfully'
@@ -1408,40 +2305,54 @@ def delete_daily_activity(daily_activity_id):
         logger.error(f"Error deleting daily activity: {str(e)}")
         return jsonify({'error': 'Server error'}), 500
 
-@app.route('/api/activities/recommend', methods=['POST'])
-@jwt_required()
-def recommend_activities():
+RECOMMEND_OPTIONS = {
+    "temperature": 0.3,
+    "max_tokens": 500
+}
+
+# How many of the locally ranked activities the optional LLM re-ranking sees
+RERANK_CANDIDATES = 15
+
+def recommendation_result(user_id, job_title, fresh=False, rerank=False, deadline=None):
+    """Rank the user's activities for `job_title`; returns (body, status) for the route or a job.
+
+    Ranking uses the local activity_index. With `rerank` the best candidates
+    are passed on to the model and its picks are returned instead.
+    """
+    response_text = ""  # Initialize with empty string
     try:
-        user_id = get_jwt_identity()
-        user = User.objects(id=user_id).first()
-        
+        user = User.objects(id=user_id).only('activity_version').first()
         if not user:
-            return jsonify({'error': 'User not found'}), 404
-
-        data = request.get_json()
-        job_title = data.get('job_title')
-        response_text = ""  # Initialize with empty string
-        
-        if not job_title:
-            return jsonify({'error': 'Job title is required'}), 400
+            return {'error': 'User not found'}, 404
+
+        ranked = activity_index.search(str(user_id), user.activity_version, job_title, RERANK_CANDIDATES)
+        if not ranked:
+            return {'error': 'No activities found for user'}, 404
+
+        # Activities sharing a word with the job title; if none do, the most recent ones
+        matches = [title for title, score in ranked if score > 0] or [title for title, _ in ranked[:3]]
+        local_recommendations = list(dict.fromkeys(matches))[:5]
+        if not rerank:
+            return {'recommended_activities': local_recommendations}, 200
+
+        candidate_titles = [title for title, _ in ranked]
+        activities = sorted(
+            Activity.objects(user=user_id, title__in=candidate_titles)
+            .only('title', 'activity_type', 'description', 'skills'),
+            key=lambda activity: candidate_titles.index(activity.title)
+        )
 
-        activities = user.activities
-        if not activities:
-            return jsonify({'error': 'No activities found for user'}), 404
-
-        activities_data = []
-        for activity in activities:
-            activity_data = {
-                'activity_id': activity.activity_id,
-                'title': activity.title,
-                'activity_type': getattr(activity, 'activity_type', 'general'),
-                'description': getattr(activity, 'description', ''),
-                'skills': getattr(activity, 'skills', [])
-            }
-            activities_data.append(activity_data)
+        # Send the candidates in ranked order and only as many as fit the budget
+        budget = PromptBudget(PROMPT_TOKEN_BUDGET)
+        activities_data = budget.fit(dedupe([{
+            'title': activity.title,
+            'activity_type': getattr(activity, 'activity_type', 'general'),
+            'description': truncate_text(getattr(activity, 'description', ''), PROMPT_DESCRIPTION_CHARS),
+            'skills': getattr(activity, 'skills', [])
+        } for activity in activities], ('title',)))
 
         prompt = f"""Analyze these activities for a {job_title} position:
-        {json.dumps(activities_data, indent=2)}
+        {compact_json(activities_data)}
         
         Return ONLY a JSON array of 3-5 most relevant activity TITLES (not IDs) using this exact format:
         ["Title 1", "Title 2", "Title 3"]
@@ -1451,44 +2362,27 @@ def recommend_activities():
         2. No empty strings
         3. Only include titles that exist in the activities list
         4. Return valid JSON only, no extra text"""
+        log_prompt('Recommendation', prompt, budget)
 
         try:
-            response = requests.post(
-                "http://localhost:11434/api/generate",
-                json={
-                    "model": "mistral",
-                    "prompt": prompt,
-                    "stream": False,
-                    "options": {
-                        "temperature": 0.3,
-                        "max_tokens": 500
-                    }
-                },
-                timeout=60
-            )
-            response.raise_for_status()
-            response_data = response.json()
-            response_text = response_data.get("response", "")
+            response_text = ollama.generate(prompt, RECOMMEND_OPTIONS, fresh=fresh, deadline=deadline)
             
+        except DeadlineExceeded:
+            # The local ranking is already a good answer
+            logger.warning("Recommendation re-ranking stopped at its deadline")
+            return {'recommended_activities': local_recommendations}, 200
         except requests.exceptions.RequestException as e:
             response_text = f"API request failed: {str(e)}"
             raise
 
-        # Parse the response
+        # Parse the response; the local ranking is used if nothing usable comes back
         try:
-            # Clean response text
-            clean_response = response_text.strip().replace('```json', '').replace('```', '')
-            
-            # First try to parse directly
-            recommended_activities = json.loads(clean_response)
-        except json.JSONDecodeError:
-            # Fallback: Extract JSON array using regex
-            json_match = re.search(r'\[.*?\]', clean_response, re.DOTALL)
-            if json_match:
-                recommended_activities = json.loads(json_match.group())
-            else:
-                recommended_activities = []
-                logger.warning(f"Failed to parse JSON from response: {clean_response}")
+            recommended_activities = extract_json(response_text)
+        except LLMOutputError:
+            recommended_activities = []
+            logger.warning(f"Failed to parse JSON from response: {response_text[:500]}")
+        if not isinstance(recommended_activities, list):
+            recommended_activities = []
 
         # Validation and processing
         valid_titles = {activity.title.lower(): activity.title for activity in activities}
@@ -1500,28 +2394,56 @@ def recommend_activities():
                 if clean_title and clean_title in valid_titles:
                     validated_activities.append(valid_titles[clean_title])
 
-        # Remove duplicates and limit results
-        final_recommendations = list(dict.fromkeys(validated_activities))[:5]
+        # Remove duplicates and limit results, keeping the local ranking if the model gave nothing usable
+        final_recommendations = list(dict.fromkeys(validated_activities))[:5] or local_recommendations
         
-        return jsonify({'recommended_activities': final_recommendations}), 200
+        return {'recommended_activities': final_recommendations}, 200
 
+    except LLMBusyError:
+        raise
     except Exception as e:
         logger.error(f"Recommendation error: {str(e)}\nRaw response: {response_text}")
-        return jsonify({
+        return {
             'error': 'Failed to generate recommendations',
             'details': str(e),
             'raw_response': response_text[:500]  # Limit to first 500 chars
-        }), 500
+        }, 500
+
+@app.route('/api/activities/recommend', methods=['POST'])
+@jwt_required()
+def recommend_activities():
+    try:
+        user_id = get_jwt_identity()
+        data = request.get_json()
+        job_title = data.get('job_title')
+        
+        if not job_title:
+            return jsonify({'error': 'Job title is required'}), 400
+
+        if wants_fresh():
+            data['fresh'] = True
+        # ?rerank=1 lets the model re-order the locally ranked candidates
+        if request.args.get('rerank') in ('1', 'true'):
+            data['rerank'] = True
+
+        if wants_async():
+            return submit_generation_job('recommend', user_id, data)
+
+        body, status = recommendation_result(user_id, job_title, fresh=wants_fresh(),
+                                             rerank=bool(data.get('rerank')), deadline=request_deadline())
+        return jsonify(body), status
+
+    except LLMBusyError as e:
+        return llm_busy_response(e)
+    except Exception as e:
+        logger.error(f"Recommendation error: {str(e)}")
+        return jsonify({'error': 'Failed to generate recommendations', 'details': str(e)}), 500
 
 @app.route('/api/user/gemini_api_key', methods=['PUT'])
 @jwt_required()
 def set_gemini_api_key():
     try:
         user_id = get_jwt_identity()
-        user = User.objects(id=user_id).first()
-        
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
 
         data = request.get_json()
         if 'api_key' not in data:
@@ -1529,11 +2451,11 @@ def set_gemini_api_key():
         
         # Encrypt and update whether key exists or not
         encrypted_key = encrypt_api_key(data['api_key'])
-        user.gemini_api_key = encrypted_key
-        user.save()
+        if not User.objects(id=user_id).update_one(set__gemini_api_key=encrypted_key):
+            return jsonify({'error': 'User not found'}), 404
 
         return jsonify({
-            'message': 'API key updated successfully' if user.gemini_api_key else 'API key set successfully',
+            'message': 'API key updated successfully',
             'encrypted_at': datetime.now(timezone.utc).isoformat()
         }), 200
 
@@ -1541,5 +2463,365 @@ def set_gemini_api_key():
         logger.error(f"API key update error: {str(e)}")
         return jsonify({'error': 'Server error'}), 500
 
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+# A running job whose worker died is handed to another worker after this long
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', 600))
+MAX_JOB_ATTEMPTS = 3
+JOB_POLL_INTERVAL = 0.5
+# A job event stream ends after this long; the client reconnects to keep waiting
+JOB_STREAM_SECONDS = int(os.getenv('JOB_STREAM_SECONDS', 120))
+
+def job_deadline():
+    # Stop before the lease runs out and another worker picks the job up again
+    return Deadline(JOB_LEASE_SECONDS)
+
+def run_cover_letter_job(user_id, payload):
+    user = User.objects(id=user_id).only(*COVER_LETTER_USER_FIELDS).first()
+    if not user:
+        return {'error': 'User not found'}, 404
+    return cover_letter_result(user, payload, deadline=job_deadline())
+
+def run_resume_job(user_id, payload):
+    user = User.objects(id=user_id).only(*RESUME_USER_FIELDS).first()
+    if not user:
+        return {'error': 'User not found'}, 404
+    return complete_resume(*prepare_resume(user, payload), fresh=payload.get('fresh', False),
+                           deadline=job_deadline())
+
+def run_recommend_job(user_id, payload):
+    return recommendation_result(user_id, payload['job_title'], fresh=payload.get('fresh', False),
+                                 rerank=bool(payload.get('rerank')), deadline=job_deadline())
+
+def run_resume_draft_job(user_id, payload):
+    """Generate the user's general resume in the background so its sections are memoized.
+
+    The next general resume with no target job then finds every section in
+    llm_cache and needs no generation at all.
+    """
+    # Low priority: give way whenever interactive generations are running or waiting.
+    # The job is pushed back rather than retried, so workers stay free for them.
+    run_later = datetime.utcnow() + timedelta(seconds=RESUME_PREGENERATE_DELAY)
+    if ollama.in_flight or ollama.waiting:
+        raise JobDeferred(run_later)
+
+    user = User.objects(id=user_id).only(*RESUME_USER_FIELDS, 'profile_version', 'resume_draft_version').first()
+    if not user:
+        return {'error': 'User not found'}, 404
+    if user.resume_draft_version == user.profile_version:
+        return {'profile_version': user.profile_version, 'generated': False}, 200
+
+    try:
+        generate_resume_content(resume_input_data(user, {'type': 'general'}), deadline=job_deadline())
+    except LLMBusyError:
+        raise JobDeferred(run_later)
+    User.objects(id=user_id).update_one(set__resume_draft_version=user.profile_version)
+    return {'profile_version': user.profile_version, 'generated': True}, 200
+
+JOB_HANDLERS = {
+    'cover_letter': run_cover_letter_job,
+    'resume': run_resume_job,
+    'recommend': run_recommend_job,
+    'resume_draft': run_resume_draft_job,
+}
+
+# Opt-in: regenerate a user's general resume once their profile or activity writes settle
+RESUME_PREGENERATE = os.getenv('RESUME_PREGENERATE', '').lower() in ('1', 'true')
+RESUME_PREGENERATE_DELAY = int(os.getenv('RESUME_PREGENERATE_DELAY', 60))
+
+def schedule_resume_draft(user_id):
+    """Queue a resume draft job for the user, or push back the one already waiting (debounce)."""
+    if not RESUME_PREGENERATE:
+        return
+    now = datetime.utcnow()
+    GenerationJob.objects(user_id=ObjectId(user_id), kind='resume_draft', status='queued').update_one(
+        upsert=True,
+        set__run_after=now + timedelta(seconds=RESUME_PREGENERATE_DELAY),
+        set_on_insert__priority=1,
+        set_on_insert__created_at=now
+    )
+
+def claim_generation_job():
+    """Atomically move the oldest due queued (or abandoned) job to running, background jobs last."""
+    now = datetime.utcnow()
+    return (GenerationJob.objects(
+                (Q(status='queued') & (Q(run_after=None) | Q(run_after__lte=now)))
+                | Q(status='running', started_at__lt=now - timedelta(seconds=JOB_LEASE_SECONDS)))
+            .order_by('priority', 'created_at')
+            .modify(new=True, set__status='running', set__started_at=now, inc__attempts=1))
+
+def execute_generation_job(job):
+    started = time.monotonic()
+    if job.attempts > MAX_JOB_ATTEMPTS:
+        body, status = {'error': 'Job abandoned after repeated worker failures'}, 500
+    else:
+        try:
+            body, status = JOB_HANDLERS[job.kind](job.user_id, job.payload)
+        except LLMBusyError as e:
+            # Put it back at its place in the queue rather than failing it
+            GenerationJob.objects(id=job.id).update_one(
+                set__status='queued', unset__started_at=True, dec__attempts=1)
+            time.sleep(min(e.retry_after, 10))
+            return
+        except JobDeferred as e:
+            # Not due yet; the worker moves straight on to the next job
+            GenerationJob.objects(id=job.id).update_one(
+                set__status='queued', set__run_after=e.run_after, unset__started_at=True, dec__attempts=1)
+            return
+        except Exception as e:
+            logger.error(f"Error running {job.kind} job {job.id}: {str(e)}")
+            body, status = {'error': 'Generation failed', 'details': str(e)}, 500
+
+    failed = status >= 400
+    GenerationJob.objects(id=job.id).update_one(
+        set__status='failed' if failed else 'done',
+        set__status_code=status,
+        set__result=body,
+        set__error=body.get('error') if failed else None,
+        set__finished_at=datetime.utcnow()
+    )
+    job_stats.record((job.started_at - job.created_at).total_seconds(),
+                     time.monotonic() - started, failed=failed)
+
+job_stats = JobStats()
+job_pool = JobWorkerPool(claim_generation_job, execute_generation_job,
+                         workers=JOB_WORKERS, poll_interval=JOB_POLL_INTERVAL * 2)
+
+def start_background_threads():
+    """Start the job workers and the LLM probe thread, which warms the models.
+
+    Only processes that serve requests call this, never CLI commands or the
+    reloader's parent. Calling it again does nothing.
+    """
+    job_pool.start()
+    ollama.start()
+
+@app.before_request
+def start_job_workers():
+    # Servers that did not start them at launch (e.g. a WSGI server without a hook)
+    start_background_threads()
+
+def submit_generation_job(kind, user_id, payload):
+    """Queue a generation and answer 202 with where to poll for it."""
+    job = GenerationJob(user_id=ObjectId(user_id), kind=kind, payload=payload).save()
+    job_pool.notify()
+    status_url = f'/api/jobs/{job.id}'
+    response = jsonify({'job_id': str(job.id), 'status': job.status, 'status_url': status_url})
+    response.headers['Location'] = status_url
+    response.headers['Preference-Applied'] = 'respond-async'
+    return response, 202
+
+def serialize_job(job):
+    job_data = {
+        'job_id': str(job.id),
+        'kind': job.kind,
+        'status': job.status,
+        'created_at': job.created_at.isoformat(),
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if job.status == 'queued':
+        job_data['queue_position'] = GenerationJob.objects(
+            status='queued', priority__lte=job.priority, created_at__lt=job.created_at).count() + 1
+    if job.status in ('done', 'failed'):
+        job_data['status_code'] = job.status_code
+        job_data['result'] = job.result
+    return job_data
+
+def stream_job(job_id, user_id):
+    """Send a `status` event whenever the job changes, ending with `done` or `failed`.
+
+    A comment is sent on every poll so a client that left is noticed at the
+    next write. After JOB_STREAM_SECONDS the stream ends with `timeout`.
+    """
+    def events():
+        last_status = None
+        give_up = time.monotonic() + JOB_STREAM_SECONDS
+        while True:
+            job = GenerationJob.objects(id=job_id, user_id=user_id).first()
+            if job is None:
+                yield sse_event('error', {'error': 'Job not found'})
+                return
+            if job.status in ('done', 'failed'):
+                yield sse_event(job.status, serialize_job(job))
+                return
+            if time.monotonic() >= give_up:
+                yield sse_event('timeout', serialize_job(job))
+                return
+            if job.status != last_status:
+                last_status = job.status
+                yield sse_event('status', serialize_job(job))
+            else:
+                yield ': ping\n\n'
+            time.sleep(JOB_POLL_INTERVAL)
+
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@jwt_required()
+def get_job(job_id):
+    try:
+        user_id = get_jwt_identity()
+        if not ObjectId.is_valid(job_id):
+            return jsonify({'error': 'Job not found'}), 404
+
+        if wants_event_stream():
+            return stream_job(job_id, user_id)
+
+        job = GenerationJob.objects(id=job_id, user_id=user_id).first()
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+
+        return jsonify(serialize_job(job)), 200
+
+    except Exception as e:
+        logger.error(f"Error fetching job: {str(e)}")
+        return jsonify({'error': 'Server error'}), 500
+
+@app.route('/api/metrics', methods=['GET'])
+@jwt_required()
+def get_metrics():
+    try:
+        return jsonify({
+            'response_cache': response_cache.stats(),
+            'llm_cache': llm_cache.stats(),
+            'llm': ollama.stats(),
+            'activity_index': activity_index.stats(),
+            'jobs': {
+                'queued': GenerationJob.objects(status='queued').count(),
+                'running': GenerationJob.objects(status='running').count(),
+                'workers': job_pool.workers,
+                'busy_workers': job_pool.busy,
+                **job_stats.summary()
+            }
+        }), 200
+    except Exception as e:
+        logger.error(f"Error fetching metrics: {str(e)}")
+        return jsonify({'error': 'Server error'}), 500
+
+def migrate_embedded_activities(batch_size=500):
+    """Move the embedded User.activities/daily_activities lists into their own collections.
+
+    Users are streamed from a cursor that only projects the two legacy lists and
+    the entries are upserted in bounded batches, so the migration can be
+    re-run safely if it is interrupted.
+    """
+    users = User._get_collection()
+    targets = [
+        ('activities', 'activity_id', Activity._get_collection()),
+        ('daily_activities', 'daily_activity_id', DailyActivity._get_collection())
+    ]
+    legacy_filter = {'$or': [{field: {'$exists': True}} for field, _, _ in targets]}
+    cursor = users.find(
+        legacy_filter,
+        projection={field: 1 for field, _, _ in targets},
+        batch_size=batch_size
+    )
+
+    pending = {field: [] for field, _, _ in targets}
+    migrated_users = []
+    moved = {field: 0 for field, _, _ in targets}
+
+    def flush():
+        for field, _, collection in targets:
+            if pending[field]:
+                collection.bulk_write(pending[field], ordered=False)
+                moved[field] += len(pending[field])
+                pending[field] = []
+        if migrated_users:
+            # Only drop the embedded lists once their entries are safely written
+            users.update_many(
+                {'_id': {'$in': migrated_users}},
+                {'$unset': {field: '' for field, _, _ in targets}, '$inc': {'data_version': 1, 'activity_version': 1}}
+            )
+            migrated_users.clear()
+
+    for raw_user in cursor:
+        for field, id_field, _ in targets:
+            for entry in raw_user.get(field) or []:
+                entry = dict(entry)
+                entry.setdefault(id_field, str(uuid.uuid4()))
+                # Keyset pagination needs every entry to have a date
+                entry.setdefault('date', datetime.utcnow())
+                entry['user'] = raw_user['_id']
+                pending[field].append(UpdateOne(
+                    {'user': raw_user['_id'], id_field: entry[id_field]},
+                    {'$setOnInsert': entry},
+                    upsert=True
+                ))
+        migrated_users.append(raw_user['_id'])
+
+        if len(migrated_users) >= batch_size or any(len(ops) >= batch_size for ops in pending.values()):
+            flush()
+
+    flush()
+    return moved
+
+def migrate_profile_images(batch_size=100):
+    """Move legacy base64 User.profile_image strings into image_blob_store.
+
+    Also renders variants for raw uploads stored by older versions, then
+    deletes the raw bytes.
+    """
+    users = User._get_collection()
+    cursor = users.find(
+        {'profile_image': {'$exists': True}},
+        projection={'profile_image': 1},
+        batch_size=batch_size
+    )
+    moved = 0
+    for raw_user in cursor:
+        update = {'$unset': {'profile_image': ''}, '$inc': {'data_version': 1}}
+        if raw_user.get('profile_image'):
+            data = base64.b64decode(raw_user['profile_image'])
+            content_type = sniff_image_type(data, default='image/jpeg')
+            image_hash = hashlib.sha256(data).hexdigest()
+            try:
+                store_image_variants(image_hash, render_variants(data))
+                update['$set'] = {
+                    'profile_image_hash': image_hash,
+                    'profile_image_type': content_type
+                }
+                moved += 1
+            except Exception as e:
+                # Not a readable image, so there is nothing worth keeping
+                logger.warning(f"Dropping unreadable profile image {image_hash}: {str(e)}")
+        users.update_one({'_id': raw_user['_id']}, update)
+
+    for image_hash in User.objects(profile_image_hash__ne=None).distinct('profile_image_hash'):
+        data = image_blob_store.get_upload(image_hash)
+        if data is None:
+            continue
+        try:
+            if not image_blob_store.has_variants(image_hash):
+                store_image_variants(image_hash, render_variants(data))
+        except Exception as e:
+            logger.warning(f"Could not render variants for {image_hash}: {str(e)}")
+            continue
+        image_blob_store.fs.delete(image_hash)
+        User.objects(profile_image_hash=image_hash).update(inc__data_version=1)
+        moved += 1
+    return moved
+
+@app.cli.command('migrate-profile-images')
+def migrate_profile_images_command():
+    """Move base64 profile images off activity_users into GridFS."""
+    logger.info(f"Migrated {migrate_profile_images()} profile images")
+
+@app.cli.command('migrate-activities')
+def migrate_activities_command():
+    """Move embedded activities out of activity_users into their own collections."""
+    moved = migrate_embedded_activities()
+    logger.info(
+        f"Migrated {moved['activities']} activities and "
+        f"{moved['daily_activities']} daily activities"
+    )
+
 if __name__ == '__main__':
+    # With debug on, the reloader's child (WERKZEUG_RUN_MAIN) is the process that serves
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_threads()
     app.run(host='0.0.0.0', port=6106, debug=True) 
\ No newline at end of file
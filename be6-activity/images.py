@@ -0,0 +1,37 @@
+"""Profile image normalisation, run in a worker process pool by app.py."""
+import io
+
+from PIL import Image, ImageOps
+
+# Longest side, in pixels, of each stored variant
+IMAGE_VARIANTS = {
+    'avatar': 128,
+    'resume': 400,
+    'full': 1024,
+}
+
+def render_variants(data):
+    """Re-encode image bytes into every size in IMAGE_VARIANTS.
+
+    The image is rotated according to its EXIF orientation and re-encoded
+    without any metadata. Returns {variant: (bytes, content_type)}.
+    """
+    with Image.open(io.BytesIO(data)) as source:
+        image = ImageOps.exif_transpose(source)
+        has_alpha = image.mode in ('RGBA', 'LA') or (
+            image.mode == 'P' and 'transparency' in image.info
+        )
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    # Largest first, each variant shrunk in place from the one before
+    variants = {}
+    for name, size in sorted(IMAGE_VARIANTS.items(), key=lambda item: -item[1]):
+        image.thumbnail((size, size), Image.LANCZOS)
+        output = io.BytesIO()
+        if has_alpha:
+            image.save(output, 'PNG', optimize=True)
+            variants[name] = (output.getvalue(), 'image/png')
+        else:
+            image.save(output, 'JPEG', quality=85, optimize=True, progressive=True)
+            variants[name] = (output.getvalue(), 'image/jpeg')
+    return variants
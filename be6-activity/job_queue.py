@@ -0,0 +1,109 @@
+"""Fixed-size pool of worker threads draining a persistent job queue.
+
+The queue itself lives in the database: the pool only calls claim() to take
+the next job (returning None when there is none) and execute() to run it, so
+any number of processes can share one queue.
+"""
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class JobDeferred(Exception):
+    """Raised by a job to be put back in the queue until `run_after` (a UTC datetime)."""
+
+    def __init__(self, run_after):
+        super().__init__(f'Deferred until {run_after.isoformat()}')
+        self.run_after = run_after
+
+
+def summarize(samples):
+    if not samples:
+        return {'avg': None, 'p95': None, 'max': None}
+    ordered = sorted(samples)
+    return {
+        'avg': round(sum(ordered) / len(ordered), 3),
+        'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        'max': round(ordered[-1], 3),
+    }
+
+
+class JobStats:
+    """Wait and run times of the last `window` jobs finished by this process."""
+
+    def __init__(self, window=200):
+        self.wait_times = deque(maxlen=window)
+        self.run_times = deque(maxlen=window)
+        self.completed = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def record(self, wait, run, failed=False):
+        with self.lock:
+            self.wait_times.append(wait)
+            self.run_times.append(run)
+            if failed:
+                self.failed += 1
+            else:
+                self.completed += 1
+
+    def summary(self):
+        with self.lock:
+            return {
+                'completed': self.completed,
+                'failed': self.failed,
+                'wait_seconds': summarize(self.wait_times),
+                'run_seconds': summarize(self.run_times),
+            }
+
+
+class JobWorkerPool:
+    """Daemon threads that claim and execute jobs until the process exits."""
+
+    def __init__(self, claim, execute, workers=2, poll_interval=1.0):
+        self.claim = claim
+        self.execute = execute
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.busy = 0
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'job-worker-{i}', daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def notify(self):
+        """Wake idle workers after a job was queued by this process."""
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                job = self.claim()
+            except Exception as e:
+                logger.error(f"Error claiming job: {str(e)}")
+                job = None
+
+            if job is None:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+                continue
+
+            with self.lock:
+                self.busy += 1
+            try:
+                self.execute(job)
+            except Exception as e:
+                logger.error(f"Error executing job: {str(e)}")
+            finally:
+                with self.lock:
+                    self.busy -= 1
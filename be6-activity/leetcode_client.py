@@ -0,0 +1,97 @@
+"""Shared client for LeetCode's GraphQL API.
+
+The queries are parsed into DocumentNodes once at import, and one gql
+session is connected per process and reused, so its requests Session keeps
+connections to LeetCode alive instead of doing a TLS handshake per request.
+The URL is configurable so tests and benchmarks can point at a local stub.
+"""
+import threading
+
+from gql import Client, gql
+from gql.transport.requests import RequestsHTTPTransport
+
+USER_PROFILE_QUERY = gql("""
+    query getUserProfile($username: String!) {
+        allQuestionsCount {
+            difficulty
+            count
+        }
+        matchedUser(username: $username) {
+            username
+            submitStats: submitStatsGlobal {
+                acSubmissionNum {
+                    difficulty
+                    count
+                }
+            }
+            profile {
+                ranking
+                reputation
+                starRating
+            }
+        }
+    }
+""")
+
+SUBMIT_STATS_QUERY = gql("""
+    query getUserProfile($username: String!) {
+        matchedUser(username: $username) {
+            submitStats: submitStatsGlobal {
+                acSubmissionNum {
+                    difficulty
+                    count
+                }
+            }
+        }
+    }
+""")
+
+CONTEST_HISTORY_QUERY = gql("""
+    query getUserContestInfo($username: String!) {
+        userContestRankingHistory(username: $username) {
+            attended
+            rating
+            ranking
+            contest {
+                title
+                startTime
+            }
+        }
+    }
+""")
+
+USERNAME_QUERY = gql("""
+    query testUser($username: String!) {
+        matchedUser(username: $username) {
+            username
+        }
+    }
+""")
+
+
+class LeetCodeClient:
+    def __init__(self, url='https://leetcode.com/graphql', retries=3, timeout=10):
+        self.url = url
+        self.client = Client(
+            transport=RequestsHTTPTransport(url=url, verify=True, retries=retries, timeout=timeout),
+            fetch_schema_from_transport=False
+        )
+        self.session = None
+        self.lock = threading.Lock()
+
+    def execute(self, document, **variables):
+        """Run a pre-parsed query with `variables` and return its data."""
+        return self._session().execute(document, variable_values=variables)
+
+    def _session(self):
+        # Connected on first use so importing the app makes no network calls
+        with self.lock:
+            if self.session is None:
+                self.session = self.client.connect_sync()
+            return self.session
+
+    def close(self):
+        with self.lock:
+            if self.session is not None:
+                self.client.close_sync()
+                self.session = None
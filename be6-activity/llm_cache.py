@@ -0,0 +1,212 @@
+"""Content-addressed cache of LLM completions.
+
+Entries are keyed by a hash of (model, options, normalized prompt), so the
+same prompt is only generated once until the entry expires or is evicted.
+Both backends are bounded LRUs: every hit refreshes the entry's last use and
+the least recently used entries are dropped once `max_entries` is exceeded.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from pymongo.errors import DuplicateKeyError
+
+
+def llm_cache_key(model, prompt, options):
+    # Whitespace is only prompt template indentation, it does not change the answer
+    normalized = ' '.join(prompt.split())
+    material = json.dumps([model, options or {}, normalized], sort_keys=True)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class MongoLLMCacheBackend:
+    """Entries in a Mongo collection shared by all workers; expiry uses a TTL index."""
+
+    def __init__(self, get_collection, max_entries=5000, ttl=7 * 24 * 3600):
+        self.get_collection = get_collection
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._collection = None
+
+    @property
+    def collection(self):
+        if self._collection is None:
+            collection = self.get_collection()
+            collection.create_index('created_at', expireAfterSeconds=self.ttl)
+            collection.create_index('last_used_at')
+            self._collection = collection
+        return self._collection
+
+    def get(self, key):
+        # The TTL monitor only runs once a minute, so check the age here too
+        entry = self.collection.find_one_and_update(
+            {'_id': key, 'created_at': {'$gt': datetime.utcnow() - timedelta(seconds=self.ttl)}},
+            {'$set': {'last_used_at': datetime.utcnow()}},
+            projection={'text': True}
+        )
+        return entry['text'] if entry else None
+
+    def set(self, key, text):
+        now = datetime.utcnow()
+        try:
+            self.collection.replace_one(
+                {'_id': key},
+                {'text': text, 'created_at': now, 'last_used_at': now},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            pass  # Stored concurrently by another worker
+        excess = self.collection.estimated_document_count() - self.max_entries
+        if excess > 0:
+            oldest = [entry['_id'] for entry in
+                      self.collection.find({}, {'_id': True}).sort('last_used_at', 1).limit(excess)]
+            self.evictions += self.collection.delete_many({'_id': {'$in': oldest}}).deleted_count
+
+    def delete(self, key):
+        self.collection.delete_one({'_id': key})
+
+    def size(self):
+        return self.collection.estimated_document_count()
+
+
+class DiskLLMCacheBackend:
+    """One JSON file per entry in `directory`; the file mtime records the last use."""
+
+    def __init__(self, directory, max_entries=5000, ttl=7 * 24 * 3600):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry['created_at'] + self.ttl < time.time():
+            self._remove(path)
+            return None
+        os.utime(path)
+        return entry['text']
+
+    def set(self, key, text):
+        path = self._path(key)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'created_at': time.time(), 'text': text}, f)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            entries = self._entries()
+            excess = len(entries) - self.max_entries
+            if excess > 0:
+                entries.sort(key=lambda entry: entry[0])
+                for _, old_path in entries[:excess]:
+                    self._remove(old_path)
+                self.evictions += excess
+
+    def delete(self, key):
+        self._remove(self._path(key))
+
+    def size(self):
+        return len(self._entries())
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.json'):
+                    try:
+                        entries.append((entry.stat().st_mtime, entry.path))
+                    except OSError:
+                        pass  # Removed by another worker
+        return entries
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class LLMCache:
+    """Front for a cache backend that keeps hit/miss counters.
+
+    Backend failures are treated as misses so a cache outage never fails a
+    generation.
+    """
+
+    def __init__(self, backend, logger=None):
+        self.backend = backend
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        try:
+            text = self.backend.get(key) if self.backend else None
+        except Exception as e:
+            self._warn(f"LLM cache read failed: {str(e)}")
+            text = None
+        with self.lock:
+            if text is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return text
+
+    def set(self, key, text):
+        if not self.backend or not text:
+            return
+        try:
+            self.backend.set(key, text)
+        except Exception as e:
+            self._warn(f"LLM cache write failed: {str(e)}")
+
+    def delete(self, key):
+        """Drop an entry the caller could not use, e.g. unparseable output."""
+        if not self.backend:
+            return
+        try:
+            self.backend.delete(key)
+        except Exception as e:
+            self._warn(f"LLM cache delete failed: {str(e)}")
+
+    def stats(self):
+        try:
+            size = self.backend.size() if self.backend else 0
+        except Exception:
+            size = None
+        return {
+            'backend': type(self.backend).__name__ if self.backend else None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.backend.evictions if self.backend else 0,
+            'size': size,
+        }
+
+    def _warn(self, message):
+        if self.logger:
+            self.logger.warning(message)
+
+
+def create_llm_cache(backend='mongo', get_collection=None, directory=None,
+                     max_entries=5000, ttl=7 * 24 * 3600, logger=None):
+    if backend == 'disk':
+        return LLMCache(DiskLLMCacheBackend(directory, max_entries=max_entries, ttl=ttl), logger)
+    if backend == 'mongo':
+        return LLMCache(MongoLLMCacheBackend(get_collection, max_entries=max_entries, ttl=ttl), logger)
+    return LLMCache(None, logger)  # 'off'
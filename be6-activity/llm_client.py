@@ -0,0 +1,639 @@
+"""Shared HTTP client for the Ollama generate API.
+
+One keep-alive connection pool is used for all generations, and at most
+`max_in_flight` of them run at once per process. Callers that cannot get a
+slot within `queue_timeout` seconds get LLMBusyError instead of queueing
+behind minute-long generations; routes turn it into 503 + Retry-After.
+
+Identical requests (same cache key) that arrive while a generation is in
+progress in this process wait for it and share its answer instead of
+taking another slot.
+
+Several Ollama-compatible servers can be given. A background thread probes
+each one's health and latency, and every request goes to the healthy
+endpoint with the fewest requests in flight, failing over to the next one
+if it cannot connect. With hedging on, a blocking generation that runs
+longer than the recent p95 (or a fixed delay) is also sent to a second
+endpoint, and whichever answers first wins.
+
+Generations are always streamed from the server, so a Deadline can stop
+one between tokens: when it passes or the client goes away the connection
+is closed, which stops the model, and the slot is freed at once.
+
+Every request asks the server to keep the model loaded for `keep_alive`.
+The background thread also loads the configured models on each endpoint at
+start and pings endpoints that have been idle for `keep_warm_interval`, so
+users do not pay the model load time. Generations that still had to load
+the model are counted as cold starts, separately from warm ones.
+"""
+import json
+import logging
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from llm_cache import llm_cache_key
+
+logger = logging.getLogger(__name__)
+
+# A generation whose model load took longer than this counts as a cold start
+COLD_LOAD_SECONDS = 0.5
+
+
+def moving_average(previous, value):
+    return value if previous is None else 0.8 * previous + 0.2 * value
+
+
+class LLMBusyError(Exception):
+    """No generation slot became free within the queue-wait timeout."""
+
+    def __init__(self, retry_after):
+        super().__init__(f'LLM backend busy, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed, or its client went away, before the answer was ready."""
+
+
+class Deadline:
+    """When the caller stops caring about an answer.
+
+    `seconds` of None means no time limit. `disconnected` is an optional
+    callable, checked between tokens, that returns True once the client that
+    asked is gone. cancel() ends the deadline from another thread.
+    """
+
+    def __init__(self, seconds=None, disconnected=None):
+        self.expires = time.monotonic() + seconds if seconds is not None else None
+        self.disconnected = disconnected
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        if self.cancelled.is_set() or self.remaining() == 0:
+            return True
+        if self.disconnected is not None and self.disconnected():
+            self.cancel()
+            return True
+        return False
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded('Generation stopped: deadline passed or client disconnected')
+
+    def timeout(self, limit):
+        """`limit` seconds, or less if the deadline comes first."""
+        remaining = self.remaining()
+        return limit if remaining is None else min(limit, remaining)
+
+
+class Flight:
+    """One in-progress generation that identical requests wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.text = None  # Stays None if the leader stopped before finishing
+        self.error = None
+
+
+class Endpoint:
+    """One model server and what the client knows about it."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.generate_url = self.base_url + '/api/generate'
+        self.healthy = True  # Until a probe or request says otherwise
+        self.in_flight = 0
+        self.latency = None  # Moving average of probe round trips, seconds
+        self.failures = 0
+        self.last_error = None
+        self.last_used = None  # monotonic time the model was last asked for anything
+        self.load_seconds = {}  # model -> how long the last warm-up took to load it
+        self.warming = False  # A warm-up thread is loading models on it
+
+    def stats(self):
+        return {
+            'url': self.base_url,
+            'healthy': self.healthy,
+            'in_flight': self.in_flight,
+            'latency_seconds': round(self.latency, 3) if self.latency is not None else None,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'idle_seconds': round(time.monotonic() - self.last_used) if self.last_used is not None else None,
+            'warm_up_load_seconds': {model: round(seconds, 3) for model, seconds in self.load_seconds.items()},
+        }
+
+
+class TokenStream:
+    """Iterator over streamed tokens that holds a generation slot until closed.
+
+    The slot is taken before the first token is requested, so a saturated
+    backend is reported before a streaming response starts. close() (also
+    called on exhaustion) releases the slot and the HTTP connection even if
+    iteration never began.
+    """
+
+    def __init__(self, tokens, release):
+        self.tokens = tokens
+        self.release = release
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.tokens)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.tokens.close()
+            self.release()
+
+    def __del__(self):
+        self.close()
+
+
+class OllamaClient:
+    def __init__(self, base_urls, cache, model='mistral', max_in_flight=2,
+                 queue_timeout=5, pool_size=None, probe_interval=15, hedge=None,
+                 keep_alive='30m', warm_models=None, keep_warm_interval=None):
+        """`base_urls` is one URL or a list; `hedge` is None, 'p95' or a delay in seconds.
+
+        `warm_models` (default: `model`) are loaded on every endpoint when the
+        background thread starts, which needs `probe_interval` and start().
+        """
+        if isinstance(base_urls, str):
+            base_urls = [base_urls]
+        self.endpoints = [Endpoint(url) for url in base_urls]
+        self.cache = cache
+        self.model = model
+        self.max_in_flight = max_in_flight
+        self.queue_timeout = queue_timeout
+        self.probe_interval = probe_interval
+        self.hedge = hedge
+        self.keep_alive = keep_alive
+        self.warm_models = list(warm_models or [model])
+        self.keep_warm_interval = keep_warm_interval
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.endpoints),
+                              pool_maxsize=pool_size or 2 * max_in_flight)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=2 * max_in_flight, thread_name_prefix='llm-hedge')
+
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.completed = 0
+        self.avg_duration = None  # moving average of generation time, for Retry-After
+        self.flights = {}
+        self.coalesced = 0
+        self.durations = deque(maxlen=200)
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.cold_starts = 0
+        self.avg_cold_duration = None
+        self.warm_starts = 0
+        self.avg_warm_duration = None
+        self.probe_thread = None
+
+    def start(self):
+        """Start the background probe thread; it is not started at construction so imports stay cheap."""
+        with self.lock:
+            if self.probe_thread is not None or not self.probe_interval:
+                return
+            self.probe_thread = threading.Thread(target=self._probe_loop, name='llm-probe', daemon=True)
+            self.probe_thread.start()
+
+    def cache_key(self, prompt, options, model=None):
+        return llm_cache_key(model or self.model, prompt, options)
+
+    def generate(self, prompt, options, model=None, timeout=60, fresh=False, deadline=None):
+        """Return the full response to `prompt`, from the cache when possible.
+
+        `fresh` skips the cache lookup; the new answer still replaces the entry.
+        Raises DeadlineExceeded, with the generation stopped, once `deadline`
+        has expired.
+        """
+        deadline = deadline or Deadline()
+        key = self.cache_key(prompt, options, model)
+        while True:
+            if not fresh:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    return cached
+            deadline.check()
+            flight, leader = self._join(key)
+            if leader:
+                break
+            text = self._follow(flight, deadline)
+            if text is not None:
+                return text
+            fresh = False  # The leader stopped early but may have cached what it had
+
+        try:
+            self._acquire(deadline)
+        except (LLMBusyError, DeadlineExceeded) as e:
+            self._land(key, flight, error=e if isinstance(e, LLMBusyError) else None)
+            raise
+        started = time.monotonic()
+        try:
+            text = self._generate_hedged({
+                "model": model or self.model,
+                "prompt": prompt,
+                "stream": True,
+                "options": options,
+                "keep_alive": self.keep_alive
+            }, timeout, deadline)
+        except DeadlineExceeded:
+            self._land(key, flight)  # Followers have their own deadlines, let one of them take over
+            raise
+        except Exception as e:
+            self._land(key, flight, error=e)
+            raise
+        finally:
+            self._release(started)
+
+        self.cache.set(key, text)
+        self._land(key, flight, text=text)
+        return text
+
+    def stream(self, prompt, options, model=None, timeout=60, fresh=False, deadline=None):
+        """Return a TokenStream of response tokens as they are generated.
+
+        `timeout` applies to connecting and to the gap between chunks. Closing
+        the stream closes the HTTP connection, which makes Ollama stop
+        generating. A cached or shared answer is yielded as a single token, and
+        a stream that runs to completion is added to the cache. Iteration
+        raises DeadlineExceeded, closing the stream, once `deadline` expires.
+        """
+        deadline = deadline or Deadline()
+        key = self.cache_key(prompt, options, model)
+        if not fresh:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return TokenStream((token for token in [cached]), lambda: None)
+
+        flight, leader = self._join(key)
+        if not leader:
+            return TokenStream(self._follow_tokens(key, flight, deadline), lambda: None)
+
+        try:
+            self._acquire(deadline)
+        except (LLMBusyError, DeadlineExceeded) as e:
+            self._land(key, flight, error=e if isinstance(e, LLMBusyError) else None)
+            raise
+        started = time.monotonic()
+
+        def release():
+            self._release(started)
+            self._land(key, flight)  # No-op unless the stream was closed before finishing
+
+        return TokenStream(self._stream_tokens(key, flight, prompt, options, model, timeout, deadline),
+                           release)
+
+    def _stream_tokens(self, key, flight, prompt, options, model, timeout, deadline):
+        parts = []
+        try:
+            for token in self._tokens({
+                "model": model or self.model,
+                "prompt": prompt,
+                "stream": True,
+                "options": options,
+                "keep_alive": self.keep_alive
+            }, timeout, deadline):
+                parts.append(token)
+                yield token
+        except DeadlineExceeded:
+            self._land(key, flight)
+            raise
+        except Exception as e:
+            self._land(key, flight, error=e)
+            raise
+        text = ''.join(parts)
+        self.cache.set(key, text)
+        self._land(key, flight, text=text)
+
+    def _tokens(self, payload, timeout, deadline, stop=None):
+        """Yield the response tokens of one streamed request until the final chunk.
+
+        Stops with DeadlineExceeded as soon as `deadline` expires or `stop`
+        is set; closing the connection is what makes the server stop too.
+        """
+        deadline.check()
+        started = time.monotonic()
+        endpoint, response = self._post(payload, timeout, deadline)
+        try:
+            for line in response.iter_lines():
+                if deadline.expired() or (stop is not None and stop.is_set()):
+                    raise DeadlineExceeded('Generation stopped: deadline passed or client disconnected')
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if chunk.get("error"):
+                    raise RuntimeError(chunk["error"])
+                if chunk.get("response"):
+                    yield chunk["response"]
+                if chunk.get("done"):
+                    self._record_start(chunk, time.monotonic() - started)
+                    return
+            raise RuntimeError('Generation ended without a final chunk')
+        except requests.exceptions.Timeout:
+            deadline.check()  # Read timeouts are shortened to the deadline
+            raise
+        finally:
+            response.close()
+            self._finish(endpoint)
+
+    def _choose(self, exclude=()):
+        """Take the least loaded healthy endpoint, or any if none is known to be healthy."""
+        with self.lock:
+            candidates = [e for e in self.endpoints if e not in exclude]
+            candidates = [e for e in candidates if e.healthy] or candidates
+            if not candidates:
+                return None
+            endpoint = min(candidates, key=lambda e: (e.in_flight, e.latency or 0))
+            endpoint.in_flight += 1
+            return endpoint
+
+    def _finish(self, endpoint, error=None):
+        with self.lock:
+            endpoint.in_flight -= 1
+            endpoint.last_used = time.monotonic()
+            if error is not None:
+                # Out of rotation until the next successful probe
+                endpoint.healthy = False
+                endpoint.failures += 1
+                endpoint.last_error = str(error)
+
+    def _post(self, payload, timeout, deadline):
+        """Start a streamed POST to the best endpoint, moving on to the next if it cannot be reached.
+
+        Returns (endpoint, response); the caller must call _finish(endpoint).
+        """
+        tried = []
+        error = None
+        while True:
+            endpoint = self._choose(tried)
+            if endpoint is None:
+                raise error
+            response = None
+            try:
+                response = self.session.post(endpoint.generate_url, json=payload,
+                                             stream=True, timeout=max(0.1, deadline.timeout(timeout)))
+                response.raise_for_status()
+                return endpoint, response
+            except requests.exceptions.ConnectionError as e:
+                if deadline.expired():
+                    # Cut short by our own deadline, not the endpoint's fault
+                    self._finish(endpoint)
+                    deadline.check()
+                self._finish(endpoint, error=e)
+                tried.append(endpoint)
+                error = e
+            except Exception:
+                # e.g. a 404 for a missing model; release the pooled connection
+                if response is not None:
+                    response.close()
+                self._finish(endpoint)
+                raise
+
+    def _generate_once(self, payload, timeout, deadline, stop=None):
+        return ''.join(self._tokens(payload, timeout, deadline, stop))
+
+    def hedge_delay(self):
+        if self.hedge is None or len(self.endpoints) < 2:
+            return None
+        if self.hedge != 'p95':
+            return float(self.hedge)
+        if len(self.durations) < 20:
+            return None  # Not enough history for a meaningful p95
+        ordered = sorted(self.durations)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def _generate_hedged(self, payload, timeout, deadline):
+        delay = self.hedge_delay()
+        if delay is None:
+            return self._generate_once(payload, timeout, deadline)
+
+        primary_stop = threading.Event()
+        primary = self.executor.submit(self._generate_once, payload, timeout, deadline, primary_stop)
+        try:
+            return primary.result(timeout=deadline.timeout(delay))
+        except FutureTimeoutError:
+            pass
+
+        # The backup request needs its own slot; without a spare one just keep waiting
+        if deadline.expired() or not self.slots.acquire(blocking=False):
+            return primary.result()
+        with self.lock:
+            self.hedged += 1
+        backup_stop = threading.Event()
+        backup = self.executor.submit(self._generate_once, payload, timeout, deadline, backup_stop)
+        backup.add_done_callback(lambda future: self.slots.release())
+
+        error = None
+        for future in as_completed([primary, backup]):
+            try:
+                text = future.result()
+            except Exception as e:
+                error = e
+                continue
+            # Stop the slower request so its server and slot are freed
+            (primary_stop if future is backup else backup_stop).set()
+            if future is backup:
+                with self.lock:
+                    self.hedge_wins += 1
+            return text
+        raise error
+
+    def _record_start(self, chunk, duration):
+        # Ollama reports in its final chunk how long loading the model took, in nanoseconds
+        cold = chunk.get("load_duration", 0) / 1e9 >= COLD_LOAD_SECONDS
+        with self.lock:
+            if cold:
+                self.cold_starts += 1
+                self.avg_cold_duration = moving_average(self.avg_cold_duration, duration)
+            else:
+                self.warm_starts += 1
+                self.avg_warm_duration = moving_average(self.avg_warm_duration, duration)
+
+    def _probe_loop(self):
+        while True:
+            for endpoint in self.endpoints:
+                self.probe(endpoint)
+                with self.lock:
+                    warm = endpoint.healthy and not endpoint.warming and self._needs_warming(endpoint)
+                    endpoint.warming = endpoint.warming or warm
+                if warm:
+                    # Loading a model can take minutes; keep probing the other endpoints meanwhile
+                    threading.Thread(target=self._warm_all, args=(endpoint,), name='llm-warm', daemon=True).start()
+            time.sleep(self.probe_interval)
+
+    def _warm_all(self, endpoint):
+        try:
+            for model in self.warm_models:
+                self.warm(endpoint, model)
+        finally:
+            with self.lock:
+                endpoint.warming = False
+
+    def _needs_warming(self, endpoint):
+        # Never used yet (startup, or the endpoint was down until now), or idle long enough to unload
+        if endpoint.last_used is None:
+            return True
+        return bool(self.keep_warm_interval) and time.monotonic() - endpoint.last_used >= self.keep_warm_interval
+
+    def warm(self, endpoint, model):
+        """Load `model` on `endpoint` (a request without a prompt) and keep it for keep_alive."""
+        started = time.monotonic()
+        try:
+            response = self.session.post(endpoint.generate_url,
+                                         json={"model": model, "keep_alive": self.keep_alive},
+                                         timeout=300)
+            response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"Warming {model} on {endpoint.base_url} failed: {str(e)}")
+            return
+        # A load-only response carries no load_duration, so time the whole request
+        load_seconds = time.monotonic() - started
+        with self.lock:
+            endpoint.last_used = time.monotonic()
+            endpoint.load_seconds[model] = load_seconds
+        logger.info(f"Warmed {model} on {endpoint.base_url} in {load_seconds:.1f}s")
+
+    def probe(self, endpoint):
+        """Check that `endpoint` answers and serves the model, and time the round trip."""
+        started = time.monotonic()
+        try:
+            response = self.session.get(endpoint.base_url + '/api/tags', timeout=5)
+            response.raise_for_status()
+            models = [m.get('name', '') for m in response.json().get('models', [])]
+            if models and not any(name.split(':')[0] == self.model for name in models):
+                raise RuntimeError(f'model {self.model} not available')
+        except Exception as e:
+            with self.lock:
+                if endpoint.healthy:
+                    logger.warning(f"LLM endpoint {endpoint.base_url} is unhealthy: {str(e)}")
+                endpoint.healthy = False
+                endpoint.last_error = str(e)
+            return
+
+        latency = time.monotonic() - started
+        with self.lock:
+            endpoint.healthy = True
+            endpoint.latency = moving_average(endpoint.latency, latency)
+
+    def _follow_tokens(self, key, flight, deadline):
+        text = self._follow(flight, deadline)
+        if text is None:
+            text = self.cache.get(key)
+            if text is None:
+                raise RuntimeError('Identical generation was cancelled')
+        yield text
+
+    def _join(self, key):
+        """Return (flight, True) to lead a new generation or (flight, False) to wait on one."""
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                return flight, False
+            flight = self.flights[key] = Flight()
+            return flight, True
+
+    def _land(self, key, flight, text=None, error=None):
+        with self.lock:
+            if flight.done.is_set():
+                return
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            flight.text = text
+            flight.error = error
+            flight.done.set()
+
+    def _follow(self, flight, deadline):
+        """Wait for the leader's answer; None means it stopped before finishing.
+
+        Only `deadline` limits the wait: the leader streams for as long as it
+        keeps receiving tokens, and always lands its flight when it stops.
+        """
+        # Short waits so a cancelled deadline or a client that left is noticed
+        while not flight.done.wait(deadline.timeout(1.0)):
+            deadline.check()
+        if flight.error is not None:
+            raise flight.error
+        return flight.text
+
+    def _acquire(self, deadline):
+        with self.lock:
+            self.waiting += 1
+        acquired = self.slots.acquire(timeout=deadline.timeout(self.queue_timeout))
+        with self.lock:
+            self.waiting -= 1
+            if acquired:
+                self.in_flight += 1
+                return
+        deadline.check()
+        with self.lock:
+            self.rejected += 1
+        raise LLMBusyError(self.retry_after())
+
+    def _release(self, started):
+        duration = time.monotonic() - started
+        with self.lock:
+            self.in_flight -= 1
+            self.completed += 1
+            self.durations.append(duration)
+            self.avg_duration = moving_average(self.avg_duration, duration)
+        self.slots.release()
+
+    def retry_after(self):
+        # Roughly when the callers already waiting would have been served
+        if self.avg_duration is None:
+            return 1
+        rounds = (self.waiting + 1) / self.max_in_flight
+        return max(1, math.ceil(self.avg_duration * rounds))
+
+    def stats(self):
+        return {
+            'max_in_flight': self.max_in_flight,
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'rejected': self.rejected,
+            'completed': self.completed,
+            'coalesced': self.coalesced,
+            'flights': len(self.flights),
+            'avg_duration_seconds': round(self.avg_duration, 3) if self.avg_duration is not None else None,
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+            'keep_alive': self.keep_alive,
+            'cold_starts': self.cold_starts,
+            'avg_cold_duration_seconds': (round(self.avg_cold_duration, 3)
+                                          if self.avg_cold_duration is not None else None),
+            'warm_starts': self.warm_starts,
+            'avg_warm_duration_seconds': (round(self.avg_warm_duration, 3)
+                                          if self.avg_warm_duration is not None else None),
+            'endpoints': [endpoint.stats() for endpoint in self.endpoints],
+        }
@@ -0,0 +1,58 @@
+"""Helpers for reading JSON out of LLM output."""
+import json
+import re
+
+OPENING_BRACKET_RE = re.compile(r'[{[]')
+
+
+class LLMOutputError(ValueError):
+    """The model's output did not contain the JSON that was asked for."""
+
+
+def extract_json(text):
+    """Return the first valid JSON object or array in `text`.
+
+    Decodes from the first `{` or `[`; if that fails the search goes on from
+    where decoding stopped, so chatter, markdown fences and stray unmatched
+    brackets before the value are skipped in one pass over the text. A value
+    cut off at the end is rejected rather than returning a fragment of it.
+    """
+    decoder = json.JSONDecoder()
+    match = OPENING_BRACKET_RE.search(text)
+    while match:
+        start = match.start()
+        try:
+            return decoder.raw_decode(text, start)[0]
+        except json.JSONDecodeError as e:
+            match = OPENING_BRACKET_RE.search(text, max(start + 1, e.pos))
+        except RecursionError:
+            raise LLMOutputError('JSON in model output is nested too deeply')
+    raise LLMOutputError('No valid JSON value found in model output')
+
+
+def validate(value, schema, path='$'):
+    """Return a list of problems with `value` against a minimal schema.
+
+    A schema is a type (`str`, `dict`, ...), `[item_schema]` for a list, or
+    `{key: schema}` for an object that must have those keys.
+    """
+    if isinstance(schema, list):
+        if not isinstance(value, list):
+            return [f'{path} must be a list']
+        problems = []
+        for i, item in enumerate(value):
+            problems += validate(item, schema[0], f'{path}[{i}]')
+        return problems
+    if isinstance(schema, dict):
+        if not isinstance(value, dict):
+            return [f'{path} must be an object']
+        problems = []
+        for key, key_schema in schema.items():
+            if key not in value:
+                problems.append(f'{path}.{key} is missing')
+            else:
+                problems += validate(value[key], key_schema, f'{path}.{key}')
+        return problems
+    if not isinstance(value, schema):
+        return [f'{path} must be of type {schema.__name__}']
+    return []
@@ -0,0 +1,99 @@
+"""Compact user data into prompts that fit a token budget.
+
+Prompt size is what drives generation latency, so entries are deduplicated,
+long descriptions are shortened, and lists are ranked and cut so the data
+part of a prompt stays under a fixed number of tokens however much history
+a user has.
+"""
+import json
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4  # Close enough for Mistral's tokenizer on English text
+WORD_RE = re.compile(r'[a-z0-9+#]+')
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def compact_json(value):
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+def truncate_text(text, max_chars):
+    """Collapse whitespace and cut `text` at a word boundary to at most `max_chars`."""
+    text = ' '.join(str(text or '').split())
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars].rsplit(' ', 1)[0] + '...'
+
+
+def terms(text):
+    return set(WORD_RE.findall(str(text or '').lower()))
+
+
+def entry_text(entry, fields):
+    parts = []
+    for field in fields:
+        value = entry.get(field)
+        parts.append(' '.join(map(str, value)) if isinstance(value, list) else str(value or ''))
+    return ' '.join(parts)
+
+
+def dedupe(entries, fields):
+    """Drop entries whose `fields` match an earlier entry, ignoring case and spacing."""
+    seen = set()
+    unique = []
+    for entry in entries:
+        key = tuple(' '.join(entry_text(entry, [field]).lower().split()) for field in fields)
+        if key not in seen:
+            seen.add(key)
+            unique.append(entry)
+    return unique
+
+
+def rank_by_relevance(entries, query, fields, date_field=None):
+    """Order entries by how many `query` terms they share, most recent first on ties."""
+    query_terms = terms(query)
+
+    def score(entry):
+        overlap = len(query_terms & terms(entry_text(entry, fields))) if query_terms else 0
+        return overlap, str(entry.get(date_field) or '') if date_field else ''
+
+    return sorted(entries, key=score, reverse=True)
+
+
+class PromptBudget:
+    """Token accounting for the data part of one prompt.
+
+    take() charges for values that must always be included; fit() keeps
+    entries, in order, for as long as they fit and skips the rest.
+    """
+
+    def __init__(self, max_tokens):
+        self.max_tokens = max_tokens
+        self.used = 0
+        self.dropped = 0
+
+    def take(self, value):
+        self.used += estimate_tokens(compact_json(value))
+        return value
+
+    def fit(self, entries):
+        kept = []
+        for entry in entries:
+            cost = estimate_tokens(compact_json(entry)) + 1
+            if self.used + cost > self.max_tokens:
+                self.dropped += 1
+                continue
+            kept.append(entry)
+            self.used += cost
+        return kept
+
+
+def log_prompt(name, prompt, budget=None):
+    dropped = f', {budget.dropped} entries dropped to fit {budget.max_tokens}' if budget and budget.dropped else ''
+    logger.info(f"{name} prompt: ~{estimate_tokens(prompt)} tokens{dropped}")
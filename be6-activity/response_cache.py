@@ -0,0 +1,152 @@
+"""Per-user cache of serialized GET responses.
+
+Entries are keyed by (user_id, key) where the key already encodes the
+route, query string and the user's data version, so a backend shared by
+several workers can never serve a response from before a write. Writes
+additionally call invalidate_user() to free the memory straight away.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryCacheBackend:
+    """Bounded in-process LRU with a per-entry TTL."""
+
+    def __init__(self, max_entries=1024, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.user_keys = {}
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, user_id, key):
+        with self.lock:
+            entry = self.entries.get((user_id, key))
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                self._remove((user_id, key))
+                return None
+            self.entries.move_to_end((user_id, key))
+            return value
+
+    def set(self, user_id, key, value):
+        with self.lock:
+            self.entries[(user_id, key)] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end((user_id, key))
+            self.user_keys.setdefault(user_id, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate_user(self, user_id):
+        with self.lock:
+            for key in self.user_keys.pop(user_id, ()):
+                self.entries.pop((user_id, key), None)
+
+    def size(self):
+        return len(self.entries)
+
+    def _remove(self, entry_key):
+        self.entries.pop(entry_key, None)
+        user_id, key = entry_key
+        keys = self.user_keys.get(user_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.user_keys[user_id]
+
+
+class RedisCacheBackend:
+    """Redis backed cache shared by all workers. Needs the `redis` package."""
+
+    def __init__(self, url, ttl=300, prefix='respcache'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('RESPONSE_CACHE_BACKEND=redis requires the redis package')
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.evictions = 0  # Redis evicts on its own (maxmemory-policy)
+
+    def _key(self, user_id, key):
+        return f'{self.prefix}:{user_id}:{key}'
+
+    def _user_set(self, user_id):
+        return f'{self.prefix}:user:{user_id}'
+
+    def get(self, user_id, key):
+        raw = self.client.get(self._key(user_id, key))
+        if raw is None:
+            return None
+        status, body, headers = json.loads(raw)
+        return status, body.encode('latin-1'), headers
+
+    def set(self, user_id, key, value):
+        status, body, headers = value
+        pipe = self.client.pipeline()
+        pipe.set(self._key(user_id, key), json.dumps([status, body.decode('latin-1'), headers]), ex=self.ttl)
+        pipe.sadd(self._user_set(user_id), key)
+        pipe.expire(self._user_set(user_id), self.ttl)
+        pipe.execute()
+
+    def invalidate_user(self, user_id):
+        keys = self.client.smembers(self._user_set(user_id))
+        pipe = self.client.pipeline()
+        for key in keys:
+            pipe.delete(self._key(user_id, key.decode()))
+        pipe.delete(self._user_set(user_id))
+        pipe.execute()
+
+    def size(self):
+        return None
+
+
+class ResponseCache:
+    """Front for a cache backend that keeps hit/miss counters."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def get(self, user_id, key):
+        value = self.backend.get(user_id, key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, user_id, key, value):
+        self.backend.set(user_id, key, value)
+
+    def invalidate_user(self, user_id):
+        self.backend.invalidate_user(user_id)
+        with self.lock:
+            self.invalidations += 1
+
+    def stats(self):
+        return {
+            'backend': type(self.backend).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'evictions': self.backend.evictions,
+            'size': self.backend.size(),
+        }
+
+
+def create_response_cache(backend='memory', max_entries=1024, ttl=300, redis_url=None):
+    if backend == 'redis':
+        return ResponseCache(RedisCacheBackend(redis_url, ttl=ttl))
+    return ResponseCache(MemoryCacheBackend(max_entries=max_entries, ttl=ttl))
@@ -0,0 +1,206 @@
+"""Tests for OllamaClient routing, failover, hedging and deadlines against local stub servers.
+
+Run with `python -m unittest test_llm_client` from this directory.
+"""
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from llm_cache import LLMCache
+from llm_client import Deadline, DeadlineExceeded, OllamaClient
+
+# Nothing listens here, so connecting fails at once
+DEAD_URL = 'http://127.0.0.1:1'
+
+
+class StubOllama:
+    """An Ollama-like server streaming `tokens` words, `delay` seconds apart.
+
+    Loading a model (a request without a prompt) takes `load_delay` seconds.
+    """
+
+    def __init__(self, name, tokens=2, delay=0.0, load_delay=0.0, status=200, models=('mistral:latest',)):
+        self.prompts = []
+        self.aborted = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Ollama streams NDJSON in chunks
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self._send_json({'models': [{'name': model} for model in models]})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if status != 200:
+                    self.send_response(status)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if 'prompt' not in body:
+                    # A load-only request, as sent by warm()
+                    time.sleep(load_delay)
+                    self._send_json({'model': body['model'], 'done': True, 'done_reason': 'load'})
+                    return
+                stub.prompts.append(body['prompt'])
+                self.send_response(200)
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                try:
+                    for i in range(tokens):
+                        time.sleep(delay)
+                        self._send_chunk({'response': name if i == tokens - 1 else 'x ', 'done': False})
+                    self._send_chunk({'response': '', 'done': True})
+                    self.wfile.write(b'0\r\n\r\n')
+                except (BrokenPipeError, ConnectionResetError):
+                    stub.aborted += 1
+
+            def _send_chunk(self, data):
+                line = (json.dumps(data) + '\n').encode()
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+                self.wfile.flush()
+
+            def _send_json(self, data):
+                body = json.dumps(data).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class OllamaClientTest(unittest.TestCase):
+    def stub(self, name, **kwargs):
+        stub = StubOllama(name, **kwargs)
+        self.addCleanup(stub.close)
+        return stub
+
+    def client(self, urls, **kwargs):
+        kwargs.setdefault('probe_interval', 0)
+        return OllamaClient(urls, cache=LLMCache(None), **kwargs)
+
+    def test_fails_over_to_next_endpoint(self):
+        good = self.stub('good')
+        client = self.client([DEAD_URL, good.url])
+
+        # The dead endpoint is tried first while both are equally loaded
+        self.assertEqual(client.generate('hello', {}), 'x good')
+        endpoints = {e['url']: e for e in client.stats()['endpoints']}
+        self.assertFalse(endpoints[DEAD_URL]['healthy'])
+        self.assertTrue(endpoints[good.url]['healthy'])
+        self.assertEqual(client.generate('again', {}), 'x good')
+        self.assertEqual(good.prompts, ['hello', 'again'])
+
+    def test_http_error_frees_slot(self):
+        missing = self.stub('missing', status=404)
+        client = self.client(missing.url, max_in_flight=1)
+
+        with self.assertRaises(requests.exceptions.HTTPError):
+            client.generate('hello', {})
+        self.assertEqual(client.stats()['in_flight'], 0)
+        self.assertEqual(client.stats()['endpoints'][0]['in_flight'], 0)
+        # An error answer is not a connection failure, so the endpoint stays in rotation
+        self.assertTrue(client.stats()['endpoints'][0]['healthy'])
+
+    def test_hedge_returns_faster_endpoint(self):
+        slow = self.stub('slow', delay=1.0)
+        fast = self.stub('fast')
+        client = self.client([slow.url, fast.url], hedge=0.2)
+
+        started = time.monotonic()
+        self.assertEqual(client.generate('hello', {}), 'x fast')
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertEqual(client.stats()['hedged'], 1)
+        self.assertEqual(client.stats()['hedge_wins'], 1)
+
+        # The slow generation is stopped and its slot given back
+        time.sleep(1.5)
+        self.assertEqual(client.stats()['in_flight'], 0)
+        self.assertEqual([e['in_flight'] for e in client.stats()['endpoints']], [0, 0])
+
+    def test_no_hedge_before_p95_has_samples(self):
+        client = self.client(DEAD_URL, hedge='p95')
+        self.assertIsNone(client.hedge_delay())
+
+    def test_deadline_stops_generation(self):
+        slow = self.stub('slow', tokens=100, delay=0.1)
+        client = self.client(slow.url, max_in_flight=1)
+
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            client.generate('hello', {}, deadline=Deadline(0.5))
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertEqual(client.stats()['in_flight'], 0)
+
+        # The server sees the connection closed instead of generating on
+        time.sleep(0.5)
+        self.assertEqual(slow.aborted, 1)
+
+    def test_deadline_bounds_queue_wait(self):
+        slow = self.stub('slow', tokens=10, delay=0.1)
+        client = self.client(slow.url, max_in_flight=1, queue_timeout=5)
+        leader = threading.Thread(target=client.generate, args=('first', {}))
+        leader.start()
+        self.addCleanup(leader.join)
+        time.sleep(0.1)
+
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            client.generate('second', {}, deadline=Deadline(0.3))
+        self.assertLess(time.monotonic() - started, 1.0)
+
+    def test_follower_waits_for_long_generation(self):
+        # Runs well past the per-chunk timeout, which must not limit identical requests
+        slow = self.stub('slow', tokens=15, delay=0.1)
+        client = self.client(slow.url, queue_timeout=0.1)
+        answers = []
+        leader = threading.Thread(target=lambda: answers.append(client.generate('hello', {}, timeout=0.5)))
+        leader.start()
+        time.sleep(0.1)
+
+        self.assertTrue(client.generate('hello', {}, timeout=0.5).endswith('slow'))
+        leader.join()
+        self.assertEqual(client.stats()['coalesced'], 1)
+        self.assertEqual(slow.prompts, ['hello'])
+
+    def test_probe_thread_starts_on_demand(self):
+        good = self.stub('good')
+        client = self.client([DEAD_URL, good.url], probe_interval=0.1)
+        self.assertIsNone(client.probe_thread)
+
+        client.start()
+        client.start()
+        time.sleep(0.5)
+        self.assertEqual([e['healthy'] for e in client.stats()['endpoints']], [False, True])
+
+    def test_slow_warm_up_does_not_hold_up_probing(self):
+        loading = self.stub('loading', load_delay=1.0)
+        ready = self.stub('ready')
+        client = self.client([loading.url, ready.url], probe_interval=0.1)
+        client.start()
+
+        time.sleep(0.5)
+        warmed = [e['warm_up_load_seconds'] for e in client.stats()['endpoints']]
+        self.assertEqual(warmed[0], {})
+        self.assertIn('mistral', warmed[1])
+
+        time.sleep(1.0)
+        self.assertGreaterEqual(client.stats()['endpoints'][0]['warm_up_load_seconds']['mistral'], 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""Tests for extract_json and validate.
+
+Run with `python -m unittest test_llm_json` from this directory.
+"""
+import time
+import unittest
+
+from llm_json import LLMOutputError, extract_json, validate
+
+
+class ExtractJsonTest(unittest.TestCase):
+    def test_bare_value(self):
+        self.assertEqual(extract_json('{"a": [1, 2]}'), {'a': [1, 2]})
+        self.assertEqual(extract_json('["x", "y"]'), ['x', 'y'])
+
+    def test_skips_chatter_and_fences(self):
+        text = 'Sure! Here is the resume:\n```json\n{"name": "Ada"}\n```\nLet me know if you need more.'
+        self.assertEqual(extract_json(text), {'name': 'Ada'})
+
+    def test_brackets_inside_strings(self):
+        self.assertEqual(extract_json('{"note": "use } and ] freely", "n": 1}'),
+                         {'note': 'use } and ] freely', 'n': 1})
+
+    def test_skips_stray_unclosed_bracket(self):
+        self.assertEqual(extract_json('Here you go {\n{"a": [1,2]}'), {'a': [1, 2]})
+        self.assertEqual(extract_json('[Note: trimmed] ["a", "b"]'), ['a', 'b'])
+
+    def test_skips_invalid_balanced_candidate(self):
+        self.assertEqual(extract_json("{'single': 'quotes'} then {\"ok\": true}"), {'ok': True})
+
+    def test_returns_first_value(self):
+        self.assertEqual(extract_json('{"first": 1} {"second": 2}'), {'first': 1})
+
+    def test_no_json(self):
+        for text in ['', 'no json here', '{"unterminated": ', '[1, 2']:
+            with self.assertRaises(LLMOutputError):
+                extract_json(text)
+
+    def test_truncated_value_is_not_returned_in_part(self):
+        with self.assertRaises(LLMOutputError):
+            extract_json('{"jobs": [{"title": "Engineer"}, {"title": "Ana')
+
+    def test_pathological_input_is_fast(self):
+        for text in ['{' + '[' * 6000 + '}', '[1,' * 20000]:
+            started = time.monotonic()
+            with self.assertRaises(LLMOutputError):
+                extract_json(text)
+            self.assertLess(time.monotonic() - started, 0.2)
+
+
+class ValidateTest(unittest.TestCase):
+    SCHEMA = {'name': str, 'jobs': [{'title': str}]}
+
+    def test_valid(self):
+        self.assertEqual(validate({'name': 'Ada', 'jobs': [{'title': 'Engineer', 'extra': 1}]}, self.SCHEMA), [])
+
+    def test_problems_have_paths(self):
+        self.assertEqual(validate({'jobs': [{'title': 3}, 'x']}, self.SCHEMA), [
+            '$.name is missing',
+            '$.jobs[0].title must be of type str',
+            '$.jobs[1] must be an object',
+        ])
+
+    def test_wrong_container(self):
+        self.assertEqual(validate({'a': 1}, [str]), ['$ must be a list'])
+        self.assertEqual(validate([], {'a': str}), ['$ must be an object'])
+
+
+if __name__ == '__main__':
+    unittest.main()